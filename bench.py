@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Бенчмарки горячих путей AlphaTrackerBot.
+
+    python bench.py --members 10,1000,100000 --trades 1000000 --output bench.json
+
+Генерирует синтетический состав, дропы и историю продаж во временной базе,
+замеряет парсеры, calculate_score, get_top_candidates, Database.get_stats и
+AlphaTrackerBot.handle_command целиком. Результат — JSON с перцентилями
+(мкс), пригодный для сравнения прогонов между собой.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Callable, Dict, List
+
+from main import (
+    TZ, AlphaTrackerBot, Database, calculate_score, get_top_candidates,
+    parse_drop_command, parse_newdrop_command, parse_sold_command,
+)
+
+ASSETS = ["CORL", "ZK", "ALPHA", "MOVE", "HYPE"]
+
+
+class BenchBot(AlphaTrackerBot):
+    """Бот без ограничения рабочих часов — замеры не зависят от времени суток"""
+
+    def is_working_hours(self) -> bool:
+        return True
+
+
+# ============================================================================
+# СИНТЕТИЧЕСКИЕ ДАННЫЕ
+# ============================================================================
+
+def member_names(count: int) -> List[str]:
+    return [f"member{i:06d}" for i in range(count)]
+
+
+def random_drop_line(rng: random.Random, name: str) -> str:
+    refund = ",".join(str(rng.randint(0, 14)) for _ in range(rng.randint(1, 3)))
+    gap_min = rng.randint(0, 10)
+    return f"{name} {rng.randint(150, 320)}AP вернут {refund} последний {gap_min}-{gap_min + rng.randint(0, 5)}"
+
+
+def seed_database(db: Database, members: int, drops: int, trades: int, rng: random.Random):
+    names = member_names(members)
+    db.add_members(names)
+    updates = [parse_drop_command(f"/drop {random_drop_line(rng, name)}") for name in names]
+    db.update_members(updates)
+
+    now_ts = int(time.time())
+    with db.transaction() as c:
+        c.executemany("""INSERT INTO drop_events (when_ts, ap_threshold, symbol, created_at)
+                        VALUES (?, ?, ?, ?)""",
+                     [(now_ts - rng.randint(0, 90 * 86400), rng.randint(180, 260), rng.choice(ASSETS),
+                       datetime.now(TZ).isoformat()) for _ in range(drops)])
+
+        batch = []
+        for _ in range(trades):
+            qty = rng.randint(10, 500)
+            price = round(rng.uniform(0.1, 3.0), 4)
+            fees = round(rng.uniform(0, 3), 2)
+            share = rng.choice((0.0, 0.2))
+            created = datetime.fromtimestamp(now_ts - rng.randint(0, 90 * 86400), TZ).isoformat()
+            batch.append((rng.randint(1, max(drops, 1)), rng.choice(names), rng.choice(ASSETS), qty, price,
+                          qty * price, fees, qty * price - fees, share, created))
+            if len(batch) >= 50_000:
+                c.executemany("""INSERT INTO trade_reports
+                                (event_id, member_name, asset, qty, sell_price, gross_usd, fees_usd, net_usd,
+                                 share_model, created_at)
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", batch)
+                batch.clear()
+        c.executemany("""INSERT INTO trade_reports
+                        (event_id, member_name, asset, qty, sell_price, gross_usd, fees_usd, net_usd,
+                         share_model, created_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", batch)
+    return names
+
+
+# ============================================================================
+# ЗАМЕРЫ
+# ============================================================================
+
+def percentile(sorted_samples: List[int], q: float) -> float:
+    if not sorted_samples:
+        return 0.0
+    idx = min(len(sorted_samples) - 1, max(0, round(q * (len(sorted_samples) - 1))))
+    return sorted_samples[idx]
+
+
+def measure(name: str, fn: Callable[[int], object], iterations: int, budget_sec: float, **labels) -> Dict:
+    """Запускает fn(i) до iterations раз (или пока не истёк бюджет времени)"""
+    samples = []
+    deadline = time.perf_counter() + budget_sec
+    for i in range(iterations):
+        start = time.perf_counter_ns()
+        fn(i)
+        samples.append(time.perf_counter_ns() - start)
+        if len(samples) >= 5 and time.perf_counter() > deadline:
+            break
+
+    samples.sort()
+    return {
+        "name": name,
+        **labels,
+        "samples": len(samples),
+        "mean_us": sum(samples) / len(samples) / 1000,
+        "p50_us": percentile(samples, 0.50) / 1000,
+        "p90_us": percentile(samples, 0.90) / 1000,
+        "p99_us": percentile(samples, 0.99) / 1000,
+        "max_us": samples[-1] / 1000,
+    }
+
+
+def bench_parsers(iterations: int, budget: float) -> List[Dict]:
+    drop = "/drop Серёга 240AP вернут 3,5 последний 5-7"
+    newdrop = "/newdrop завтра 14:00 порог 200 CORL"
+    sold = "/sold Серёга CORL 125шт по 0.80$ комса 2.5$"
+    member = {"name": "Серёга", "ap": 240, "refund_days": [3, 5], "last_gap_days": [5, 7]}
+    return [
+        measure("parse_drop_command", lambda i: parse_drop_command(drop), iterations, budget),
+        measure("parse_newdrop_command", lambda i: parse_newdrop_command(newdrop), iterations, budget),
+        measure("parse_sold_command", lambda i: parse_sold_command(sold), iterations, budget),
+        measure("calculate_score", lambda i: calculate_score(member, 200 + i % 60), iterations, budget),
+    ]
+
+
+def bench_size(members: int, drops: int, trades: int, iterations: int, budget: float, seed: int) -> List[Dict]:
+    rng = random.Random(seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, "bench.db"))
+        start = time.perf_counter()
+        names = seed_database(db, members, drops, trades, rng)
+        seed_sec = time.perf_counter() - start
+        bot = BenchBot(db)
+        labels = {"members": members, "trades": trades}
+
+        commands = [
+            lambda i: f"/who порог {180 + i % 80}",
+            lambda i: f"/drop {random_drop_line(rng, rng.choice(names))}",
+            lambda i: f"/sold {rng.choice(names)} {rng.choice(ASSETS)} {rng.randint(10, 500)}шт по 0.80$ комса 2.5$",
+            lambda i: "/who порог 180-260 шаг 10",
+        ]
+
+        results = [
+            measure("get_top_candidates", lambda i: get_top_candidates(db, 180 + i % 80), iterations, budget,
+                    **labels),
+            measure("Database.get_stats", lambda i: db.get_stats(), iterations, budget, **labels),
+            measure("Database.get_pnl", lambda i: db.get_pnl(), iterations, budget, **labels),
+            measure("handle_command", lambda i: bot.handle_command(commands[i % len(commands)](i)),
+                    iterations, budget, **labels),
+        ]
+        for r in results:
+            r["seed_sec"] = seed_sec
+        db.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки AlphaTrackerBot")
+    parser.add_argument("--members", default="10,1000,10000", help="размеры состава через запятую")
+    parser.add_argument("--drops", type=int, default=500, help="число дропов в истории")
+    parser.add_argument("--trades", type=int, default=10_000, help="число сделок в истории")
+    parser.add_argument("--iterations", type=int, default=1000, help="повторов на замер")
+    parser.add_argument("--budget", type=float, default=5.0, help="предел секунд на один замер")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="файл для JSON (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    results = bench_parsers(args.iterations, args.budget)
+    for size in (int(x) for x in args.members.split(",")):
+        print(f"⏱  {size} участников, {args.trades} сделок...", file=sys.stderr)
+        results.extend(bench_size(size, args.drops, args.trades, args.iterations, args.budget, args.seed))
+
+    report = {
+        "meta": {
+            "created_at": datetime.now(TZ).isoformat(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
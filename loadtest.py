@@ -0,0 +1,560 @@
+#!/usr/bin/env python3
+"""
+Сквозной нагрузочный тест: TelegramBotAdapter против локальной заглушки Bot API.
+
+    python loadtest.py --chats 50 --duration 30 --mix "drop=40,who=25,sold=15,newdrop=10,stats=10"
+
+Поднимает на 127.0.0.1 заглушку Bot API (getUpdates с long polling,
+sendMessage, остальные методы отвечают ok), направляет на неё адаптер через
+TELEGRAM_API_URL и запускает его обычным start_polling на временной базе.
+N чатов работают замкнутым циклом: следующая команда чата уходит после
+ответа на предыдущую (плюс пауза --think-ms). В отчёте — пропускная
+способность, перцентили задержки ответа (от появления обновления в заглушке
+до sendMessage с reply_to на него) и время ожидания блокировки записи БД.
+
+По умолчанию рабочие часы и лимиты исходящих сообщений сняты — меряется сам
+бот; --real-hours и --telegram-limits возвращают их.
+"""
+
+import argparse
+import heapq
+import importlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from itertools import islice
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+DEFAULT_MIX = "drop=40,who=25,sold=15,newdrop=10,stats=10"
+COMMANDS = ("drop", "newdrop", "sold", "who", "stats")
+ASSETS = ["CORL", "ZK", "ALPHA", "MOVE", "HYPE"]
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "AlphaTracker", "username": "alpha_tracker_bot"}
+
+
+# ============================================================================
+# ЗАГЛУШКА BOT API
+# ============================================================================
+
+class FakeTelegramAPI:
+    """
+    Bot API на локальном порту: /bot<token>/<method>.
+
+    getUpdates держит запрос до появления обновлений (не дольше timeout) и,
+    как Telegram, забывает обновления с update_id < offset. sendMessage
+    передаёт chat_id, reply_to и текст в on_reply. Параметры принимаются и из
+    query string (так шлёт telebot), и из тела формы или JSON.
+    """
+
+    def __init__(self, on_reply: Optional[Callable[[int, Optional[int], str], None]] = None,
+                 host: str = "127.0.0.1", port: int = 0):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        self.on_reply = on_reply
+        self._cond = threading.Condition()
+        self._updates: deque = deque()
+        self._next_update_id = 1
+        self._next_message_id = 1
+        self.calls: Dict[str, int] = {}
+        # Адаптер дошёл до long polling — можно давать нагрузку
+        self.polling = threading.Event()
+
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Заголовки и тело уходят двумя записями — без TCP_NODELAY ответ ждёт delayed ACK (~40 мс)
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                api._handle(self)
+
+            do_POST = do_GET
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="fake-telegram", daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def push(self, chat_id: int, text: str) -> int:
+        """Новое входящее сообщение чата; возвращает его message_id"""
+        with self._cond:
+            update_id = self._next_update_id
+            message_id = self._next_message_id
+            self._next_update_id += 1
+            self._next_message_id += 1
+            self._updates.append({
+                "update_id": update_id,
+                "message": {
+                    "message_id": message_id,
+                    "from": {"id": abs(chat_id), "is_bot": False, "first_name": "load"},
+                    "chat": {"id": chat_id, "type": "supergroup", "title": f"load {chat_id}"},
+                    "date": int(time.time()),
+                    "text": text,
+                },
+            })
+            self._cond.notify_all()
+        return message_id
+
+    @staticmethod
+    def _params(request) -> Dict:
+        params: Dict = dict(parse_qsl(urlsplit(request.path).query))
+        length = int(request.headers.get("Content-Length") or 0)
+        if length:
+            body = request.rfile.read(length)
+            if request.headers.get("Content-Type", "").startswith("application/json"):
+                params.update(json.loads(body))
+            else:
+                params.update(parse_qsl(body.decode("utf-8")))
+        return params
+
+    def _handle(self, request):
+        method = urlsplit(request.path).path.rsplit("/", 1)[-1]
+        params = self._params(request)
+        with self._cond:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+        if method == "getUpdates":
+            result = self.get_updates(params)
+        elif method == "sendMessage":
+            result = self.send_message(params)
+        else:
+            # deleteWebhook, setWebhook и прочее — просто ok
+            result = True
+
+        body = json.dumps({"ok": True, "result": result}, ensure_ascii=False).encode("utf-8")
+        request.send_response(200)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def get_updates(self, params: Dict) -> List[Dict]:
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        wait = float(params.get("timeout") or 0)
+        if wait:
+            self.polling.set()
+
+        deadline = time.monotonic() + wait
+        with self._cond:
+            # Всё до offset подтверждено клиентом
+            while self._updates and self._updates[0]["update_id"] < offset:
+                self._updates.popleft()
+            while not self._updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return list(islice(self._updates, limit))
+
+    def send_message(self, params: Dict) -> Dict:
+        chat_id = int(params["chat_id"])
+        text = params.get("text", "")
+        reply_to = params.get("reply_to_message_id")
+        if reply_to is None and params.get("reply_parameters"):
+            # Новые версии telebot передают reply_to_message_id как reply_parameters
+            reply = params["reply_parameters"]
+            reply_to = (json.loads(reply) if isinstance(reply, str) else reply).get("message_id")
+
+        if self.on_reply:
+            self.on_reply(chat_id, int(reply_to) if reply_to else None, text)
+
+        with self._cond:
+            message_id = self._next_message_id
+            self._next_message_id += 1
+        return {
+            "message_id": message_id,
+            "from": BOT_USER,
+            "chat": {"id": chat_id, "type": "supergroup", "title": f"load {chat_id}"},
+            "date": int(time.time()),
+            "text": text,
+        }
+
+
+# ============================================================================
+# КОМАНДЫ ЧАТОВ
+# ============================================================================
+
+def parse_mix(spec: str) -> Dict[str, int]:
+    """«drop=40,who=25,...» → веса команд"""
+    mix = {}
+    for item in spec.split(","):
+        key, _, value = item.partition("=")
+        key = key.strip().lstrip("/")
+        if key not in COMMANDS:
+            raise ValueError(f"неизвестная команда {key!r} (есть: {', '.join(COMMANDS)})")
+        mix[key] = int(value)
+    if not any(mix.values()):
+        raise ValueError("все веса нулевые")
+    return mix
+
+
+def random_command(rng: random.Random, kind: str, names: List[str]) -> str:
+    """Команда в формате, который пишут участники"""
+    name = rng.choice(names)
+    if kind == "drop":
+        refund = ",".join(str(rng.randint(0, 14)) for _ in range(rng.randint(1, 3)))
+        gap_min = rng.randint(0, 10)
+        return (f"/drop {name} {rng.randint(150, 320)}AP вернут {refund} "
+                f"последний {gap_min}-{gap_min + rng.randint(0, 5)}")
+    if kind == "newdrop":
+        seats = f" мест {rng.randint(2, 6)}" if rng.random() < 0.5 else ""
+        return (f"/newdrop завтра {rng.randint(10, 22)}:{rng.choice((0, 15, 30, 45)):02d} "
+                f"порог {rng.randint(180, 260)}{seats} {rng.choice(ASSETS)}")
+    if kind == "sold":
+        return (f"/sold {name} {rng.choice(ASSETS)} {rng.randint(10, 500)}шт по "
+                f"{rng.uniform(0.05, 3.0):.2f}$ комса {rng.choice((0, 0.5, 1, 2.5))}$")
+    if kind == "who":
+        if rng.random() < 0.2:
+            start = rng.randint(16, 20) * 10
+            return f"/who порог {start}-{start + 80} шаг 10"
+        return f"/who порог {rng.randint(180, 260)}"
+    return "/stats"
+
+
+# ============================================================================
+# НАГРУЗКА
+# ============================================================================
+
+class LoadGenerator:
+    """
+    Замкнутый цикл по чатам: у каждого чата не больше одной команды без
+    ответа. Поток генератора отправляет команды по куче сроков; ответ
+    (on_reply из заглушки) фиксирует задержку и ставит следующую команду
+    чата через think_sec. Без ответа за reply_timeout команда считается
+    потерянной, и чат продолжает. С join=True первая команда чата —
+    /addmember со всем составом (у базы на чат состав изначально пуст).
+    """
+
+    def __init__(self, api: FakeTelegramAPI, chats: int, mix: Dict[str, int], names: List[str],
+                 think_sec: float = 0.0, reply_timeout: float = 30.0, seed: int = 42,
+                 join: bool = False):
+        self.api = api
+        self.chat_ids = [-1_000_000_000 - i for i in range(chats)]
+        self.kinds = [k for k in COMMANDS if mix.get(k)]
+        self.weights = [mix[k] for k in self.kinds]
+        self.names = names
+        self._unjoined = set(self.chat_ids) if join else set()
+        self.think_sec = think_sec
+        self.reply_timeout = reply_timeout
+        self.rng = random.Random(seed)
+
+        self._cond = threading.Condition()
+        # (срок, seq, chat_id, message_id): message_id=None — отправить следующую команду,
+        # иначе — проверка таймаута этой команды
+        self._heap: List[Tuple[float, int, int, Optional[int]]] = []
+        self._seq = 0
+        self._pending: Dict[int, Tuple[int, str, float]] = {}
+        self._sending = False
+        self.measure_from = 0.0
+        self.measure_to = 0.0
+
+        self.sent: Dict[str, int] = {k: 0 for k in self.kinds}
+        self.latencies: Dict[str, List[float]] = {k: [] for k in self.kinds}
+        self.error_replies: Dict[str, int] = {k: 0 for k in self.kinds}
+        self.timeouts = 0
+        self.unsolicited = 0
+        # Ответы, пришедшие внутри окна замера, — для пропускной способности
+        self.completed = 0
+
+    def _schedule_locked(self, due: float, chat_id: int, message_id: Optional[int] = None):
+        self._seq += 1
+        heapq.heappush(self._heap, (due, self._seq, chat_id, message_id))
+        self._cond.notify()
+
+    def on_reply(self, chat_id: int, reply_to: Optional[int], text: str):
+        now = time.perf_counter()
+        with self._cond:
+            pending = self._pending.get(chat_id)
+            if pending is None or pending[0] != reply_to:
+                # Напоминания, сводки очереди и т.п.
+                self.unsolicited += 1
+                return
+            del self._pending[chat_id]
+            _, kind, sent_at = pending
+            # /addmember при входе чата в статистику не попадает
+            if kind in self.latencies:
+                if self.measure_from <= now < self.measure_to:
+                    self.completed += 1
+                if sent_at >= self.measure_from:
+                    self.latencies[kind].append(now - sent_at)
+                    if text.startswith("❌"):
+                        self.error_replies[kind] += 1
+            if self._sending:
+                self._schedule_locked(now + self.think_sec, chat_id)
+
+    def run(self, warmup_sec: float, duration_sec: float):
+        """Даёт нагрузку warmup + duration секунд и дожидается ответов на отправленное"""
+        start = time.perf_counter()
+        self.measure_from = start + warmup_sec
+        stop_at = self.measure_to = self.measure_from + duration_sec
+        with self._cond:
+            self._sending = True
+            for i, chat_id in enumerate(self.chat_ids):
+                # Разносим старт чатов, чтобы не было залпа в первую миллисекунду
+                self._schedule_locked(start + self.think_sec * i / len(self.chat_ids), chat_id)
+
+        while True:
+            with self._cond:
+                now = time.perf_counter()
+                if now >= stop_at and self._sending:
+                    self._sending = False
+                    # Неотправленное больше не нужно, ждём только таймауты отправленного
+                    self._heap = [entry for entry in self._heap if entry[3] is not None]
+                    heapq.heapify(self._heap)
+                if not self._sending and not self._pending:
+                    return
+                if not self._heap or self._heap[0][0] > now:
+                    deadline = self._heap[0][0] if self._heap else None
+                    if self._sending:
+                        deadline = stop_at if deadline is None else min(deadline, stop_at)
+                    self._cond.wait(None if deadline is None else deadline - now)
+                    continue
+                _, _, chat_id, message_id = heapq.heappop(self._heap)
+
+                if message_id is not None:
+                    pending = self._pending.get(chat_id)
+                    if pending is not None and pending[0] == message_id:
+                        del self._pending[chat_id]
+                        if pending[2] >= self.measure_from:
+                            self.timeouts += 1
+                        if self._sending:
+                            self._schedule_locked(now, chat_id)
+                    continue
+                if chat_id in self._pending:
+                    continue
+                if chat_id in self._unjoined:
+                    self._unjoined.discard(chat_id)
+                    kind, text = "addmember", f"/addmember {', '.join(self.names)}"
+                else:
+                    kind = self.rng.choices(self.kinds, self.weights)[0]
+                    text = random_command(self.rng, kind, self.names)
+                # Под замком: ответ не может прийти раньше, чем записан pending
+                sent_at = time.perf_counter()
+                message_id = self.api.push(chat_id, text)
+                self._pending[chat_id] = (message_id, kind, sent_at)
+                if sent_at >= self.measure_from and kind in self.sent:
+                    self.sent[kind] += 1
+                self._schedule_locked(sent_at + self.reply_timeout, chat_id, message_id)
+
+
+# ============================================================================
+# ОТЧЁТ
+# ============================================================================
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    """Перцентили в миллисекундах"""
+    if not values:
+        return {}
+    values = sorted(values)
+    n = len(values)
+
+    def pct(q: float) -> float:
+        return values[min(n - 1, int(q * n))] * 1000
+
+    return {"count": n, "p50": pct(0.5), "p90": pct(0.9), "p99": pct(0.99),
+            "max": values[-1] * 1000, "mean": sum(values) / n * 1000}
+
+
+def histogram_delta(before: Dict, after: Dict, name: str) -> List[float]:
+    """Сумма гистограмм метрики name по всем меткам за окно замера"""
+    total: List[float] = []
+    for (metric, labels), hist in after.items():
+        if metric != name:
+            continue
+        prev = before.get((metric, labels), [0] * len(hist))
+        if not total:
+            total = [0] * len(hist)
+        for i, value in enumerate(hist):
+            total[i] += value - prev[i]
+    return total
+
+
+def histogram_summary(hist: List[float], buckets: Tuple[float, ...], wall_sec: float) -> Dict[str, float]:
+    """Число, сумма, доля от времени замера и p99 (верхняя граница корзины)"""
+    if not hist:
+        return {"count": 0, "total_sec": 0.0, "share": 0.0, "mean_ms": 0.0, "p99_le_ms": 0.0}
+    count = sum(hist[:-1])
+    seen = 0
+    p99 = float("inf")
+    for i, bucket_count in enumerate(hist[:-1]):
+        seen += bucket_count
+        if count and seen >= 0.99 * count:
+            p99 = buckets[i] if i < len(buckets) else float("inf")
+            break
+    return {
+        "count": count,
+        "total_sec": hist[-1],
+        "share": hist[-1] / wall_sec if wall_sec else 0.0,
+        "mean_ms": hist[-1] / count * 1000 if count else 0.0,
+        "p99_le_ms": p99 * 1000,
+    }
+
+
+def format_report(result: Dict) -> str:
+    cfg = result["config"]
+    lines = [f"🚦 Нагрузка: {cfg['chats']} чатов, {cfg['duration']:g} с "
+             f"(+{cfg['warmup']:g} с прогрева), think {cfg['think_ms']:g} мс, "
+             f"{'по базе на чат' if cfg['tenants'] else 'общая база'}"]
+
+    total = result["total"]
+    lines.append(f"   отправлено {result['sent']}, ответов {total.get('count', 0)}, "
+                 f"таймаутов {result['timeouts']}, ответов с ❌ {result['error_replies']}")
+    lines.append(f"   пропускная способность: {result['throughput']:.1f} команд/с")
+    if total:
+        lines.append(f"   задержка ответа, мс: p50 {total['p50']:.1f} | p90 {total['p90']:.1f} | "
+                     f"p99 {total['p99']:.1f} | max {total['max']:.1f}")
+
+    for kind, stats in result["commands"].items():
+        if stats.get("count"):
+            line = f"   • /{kind:<8} {stats['count']:>7} | p50 {stats['p50']:.1f} | p99 {stats['p99']:.1f} мс"
+            if stats["errors"]:
+                line += f" | ❌ {stats['errors']}"
+            lines.append(line)
+
+    handle = result["handle_command"]
+    lines.append(f"   handle_command: ср. {handle['mean_ms']:.2f} мс, p99 ≤{handle['p99_le_ms']:g} мс")
+    lock = result["lock_wait"]
+    lines.append(f"   ожидание блокировки записи: {lock['count']:.0f} транзакций, "
+                 f"всего {lock['total_sec']:.3f} с ({lock['share']:.1%} от замера, сумма по потокам), "
+                 f"ср. {lock['mean_ms']:.3f} мс, p99 ≤{lock['p99_le_ms']:g} мс")
+    return "\n".join(lines)
+
+
+# ============================================================================
+# ЗАПУСК
+# ============================================================================
+
+def configure_environment(api_url: str, workdir: str, tenants: bool):
+    """Окружение для main.py — до импорта: пути и адреса читаются при загрузке модуля"""
+    os.environ["TELEGRAM_API_URL"] = api_url
+    if tenants:
+        os.environ["TENANTS_DIR"] = os.path.join(workdir, "tenants")
+    else:
+        os.environ.pop("TENANTS_DIR", None)
+        os.environ["DB_PATH"] = os.path.join(workdir, "drops.db")
+    # Ничего из боевой конфигурации: ни webhook, ни копий, ни логов команд
+    for key in ("WEBHOOK_URL", "BACKUP_DIR", "COMMAND_LOG", "METRICS_FILE", "METRICS_PORT",
+                "CHAT_ID", "THREAD_ID", "ADMIN_IDS"):
+        os.environ.pop(key, None)
+
+
+def run(args, mix: Dict[str, int]) -> Dict:
+    api = FakeTelegramAPI()
+    api.start()
+    workdir = tempfile.mkdtemp(prefix="alpha-load-")
+    configure_environment(api.url, workdir, args.tenants)
+    app = importlib.import_module("main")
+
+    if not args.real_hours:
+        app.WORK_START, app.WORK_END = 0, 24
+
+    adapter = app.TelegramBotAdapter("123456:LOADTEST")
+    if not adapter.is_connected:
+        raise SystemExit(1)
+    if not args.telegram_limits:
+        adapter.outbound.stop(timeout=0)
+        adapter.outbound = app.OutboundQueue(adapter.send_outbound, chat_rate=1e6, chat_burst=1e6,
+                                             global_rate=1e6)
+
+    threading.Thread(target=adapter.start_polling, name="adapter", daemon=True).start()
+    if not api.polling.wait(30):
+        raise SystemExit("❌ Адаптер не дошёл до getUpdates за 30 с")
+
+    generator = LoadGenerator(api, args.chats, mix, list(app.KNOWN_PARTICIPANTS),
+                              think_sec=args.think_ms / 1000, reply_timeout=args.reply_timeout,
+                              seed=args.seed, join=args.tenants)
+    api.on_reply = generator.on_reply
+    print(f"⏱  {args.chats} чатов, {args.warmup:g}+{args.duration:g} с → {api.url}", file=sys.stderr)
+
+    before: Dict = {}
+    snapshot_timer = threading.Timer(args.warmup, lambda: before.update(app.METRICS.snapshot()[1]))
+    snapshot_timer.start()
+    generator.run(args.warmup, args.duration)
+    snapshot_timer.join()
+    after = app.METRICS.snapshot()[1]
+
+    # Останавливаем как при выходе start_polling: очередь, исходящие, базы.
+    # Поток polling остаётся висеть в getUpdates — он демон.
+    adapter._shutdown()
+    api.close()
+    if not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    all_latencies = [v for values in generator.latencies.values() for v in values]
+    total = percentiles(all_latencies)
+    wall_sec = args.duration
+    buckets = app.Metrics.BUCKETS
+    return {
+        "config": {"chats": args.chats, "duration": args.duration, "warmup": args.warmup,
+                   "think_ms": args.think_ms, "mix": mix, "tenants": args.tenants,
+                   "real_hours": args.real_hours, "telegram_limits": args.telegram_limits,
+                   "workdir": workdir if args.keep else None},
+        "sent": sum(generator.sent.values()),
+        "timeouts": generator.timeouts,
+        "error_replies": sum(generator.error_replies.values()),
+        "unsolicited": generator.unsolicited,
+        "throughput": generator.completed / wall_sec if wall_sec else 0.0,
+        "total": total,
+        "commands": {kind: {**percentiles(values), "errors": generator.error_replies[kind]}
+                     for kind, values in generator.latencies.items()},
+        "handle_command": histogram_summary(
+            histogram_delta(before, after, "alpha_command_latency_seconds"), buckets, wall_sec),
+        "lock_wait": histogram_summary(
+            histogram_delta(before, after, "alpha_db_lock_wait_seconds"), buckets, wall_sec),
+        "api_calls": dict(api.calls),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сквозной нагрузочный тест AlphaTrackerBot")
+    parser.add_argument("--chats", type=int, default=50, help="сколько чатов шлют команды")
+    parser.add_argument("--duration", type=float, default=30, help="секунд замера")
+    parser.add_argument("--warmup", type=float, default=2, help="секунд прогрева (не в отчёте)")
+    parser.add_argument("--think-ms", type=float, default=0, help="пауза чата между ответом и следующей командой")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"веса команд (по умолчанию {DEFAULT_MIX})")
+    parser.add_argument("--tenants", action="store_true", help="база на чат (TENANTS_DIR) вместо общей")
+    parser.add_argument("--real-hours", action="store_true", help="не снимать ограничение рабочих часов")
+    parser.add_argument("--telegram-limits", action="store_true",
+                        help="оставить лимиты исходящих сообщений (1/с на чат, 25/с всего)")
+    parser.add_argument("--reply-timeout", type=float, default=30, help="сколько ждать ответа на команду")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--keep", action="store_true", help="не удалять временную базу")
+    parser.add_argument("--output", help="файл для JSON-результата")
+    args = parser.parse_args()
+
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+
+    result = run(args, mix)
+    print(format_report(result))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
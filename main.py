@@ -3,12 +3,26 @@
 AlphaTrackerBot — управление дропами и командной работой
 """
 
+import time
+# Точка отсчёта для замера холодного старта (до polling)
+STARTUP_T0 = time.perf_counter()
+
 import sqlite3
 import json
-from datetime import datetime, timedelta
+import threading
+import heapq
+import uuid
+import os
+import sys
+from array import array
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from datetime import date, datetime, timedelta
 from zoneinfo import ZoneInfo
-from typing import List, Dict, Optional, Tuple
+from typing import Callable, ContextManager, List, Dict, Optional, Set, Tuple
 import re
+from bisect import bisect_left, insort
+from collections import OrderedDict, deque
 
 # ============================================================================
 # КОНФИГУРАЦИЯ
@@ -19,6 +33,69 @@ WORK_START = 11
 WORK_END = 23
 DAILY_FEE_USD = 2.5
 
+# Планирование дня (/plan): мест на дроп, AP за участие, максимум дропов на участника
+PLAN_SLOTS_PER_DROP = 3
+AP_SPENT_PER_DROP = 15
+PLAN_MAX_DROPS_PER_MEMBER = 3
+# Штраф за каждый следующий дроп того же участника (в единицах score ×100)
+PLAN_REPEAT_PENALTY = 150
+
+# Команды-записи: вне рабочих часов откладываются до WORK_START (остальные — отказ),
+# повтор одного обновления Telegram не применяется дважды. /reserve без имени —
+# чтение (список броней), см. is_write_command
+WRITE_COMMANDS = ("/drop", "/newdrop", "/sold", "/addmember", "/commission", "/reserve", "/release")
+
+# Сколько последних update_id помнить для отсева повторов
+SEEN_UPDATES_KEEP = 100_000
+
+# Бронь мест на дроп (/reserve): мест по умолчанию, если в /newdrop не задано «мест N»
+RESERVE_DEFAULT_SLOTS = 3
+
+# Ежедневное старение счётчиков (вернут/последний): час запуска по TZ
+AGING_HOUR = 0
+
+# Напоминания о дропе: за сколько часов до начала
+REMINDER_OFFSETS_HOURS = (4, 3, 2, 1)
+# Повтор отправки напоминаний после ошибки (сек)
+REMINDER_RETRY_SEC = 60
+
+# Параллельная обработка сообщений: потоки и предел очереди (backpressure)
+DISPATCH_WORKERS = 8
+DISPATCH_QUEUE_SIZE = 1000
+
+# Исходящие сообщения: лимиты Telegram (сообщений/сек) и повторы при ошибках
+OUTBOUND_CHAT_RATE = 1.0
+OUTBOUND_CHAT_BURST = 3
+OUTBOUND_GLOBAL_RATE = 25.0
+OUTBOUND_MAX_ATTEMPTS = 5
+OUTBOUND_BACKOFF_BASE_SEC = 1.0
+OUTBOUND_BACKOFF_MAX_SEC = 60.0
+TELEGRAM_MAX_MESSAGE = 4096
+
+# Выгрузка метрик Prometheus: файл (textfile collector) и/или локальный HTTP-порт
+METRICS_FILE = os.getenv("METRICS_FILE")
+METRICS_PORT = os.getenv("METRICS_PORT")
+METRICS_FILE_INTERVAL_SEC = 15
+
+# Путь к общей базе (на Render — постоянный диск, см. render.yaml)
+DB_PATH = os.getenv("DB_PATH", "drops.db")
+
+# Онлайн-бэкапы: каталог (пусто — выключены), час запуска по TZ, сколько копий хранить.
+# Копия снимается шагами по BACKUP_PAGES_PER_STEP страниц с паузой BACKUP_STEP_SLEEP_SEC между шагами.
+BACKUP_DIR = os.getenv("BACKUP_DIR")
+BACKUP_HOUR = 4
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+BACKUP_MIN_AGE_SEC = 20 * 3600
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_STEP_SLEEP_SEC = 0.002
+
+# Мультичат: каталог с базами чатов (пусто — одна общая база) и сколько баз держать открытыми
+TENANTS_DIR = os.getenv("TENANTS_DIR")
+TENANT_CACHE_SIZE = 32
+
+# Лог входящих команд (JSON-строки) для офлайн-реплея: python replay.py <лог>
+COMMAND_LOG = os.getenv("COMMAND_LOG")
+
 COMMISSIONED_MEMBERS = {
     "Назар": 0.2,
     "releZz": 0.2,
@@ -31,24 +108,421 @@ KNOWN_PARTICIPANTS = [
     "Андрей", "Ярик", "Серёга"
 ]
 
+# ============================================================================
+# МЕТРИКИ
+# ============================================================================
+
+class Metrics:
+    """
+    Счётчики, гистограммы задержек и гейджи в памяти процесса.
+    Отдаются командой /metrics и в текстовом формате Prometheus.
+    """
+
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, tuple], float] = {}
+        # [счётчики по корзинам..., +Inf, сумма]
+        self._histograms: Dict[Tuple[str, tuple], List[float]] = {}
+        self._gauges: Dict[str, Callable[[], float]] = {}
+        self._help: Dict[str, str] = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        idx = bisect_left(self.BUCKETS, seconds)
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [0] * (len(self.BUCKETS) + 2)
+            hist[idx] += 1
+            hist[-1] += seconds
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def gauge(self, name: str, fn: Callable[[], float], help_text: str = ""):
+        """Гейдж, значение которого читается в момент выгрузки"""
+        self._gauges[name] = fn
+        if help_text:
+            self._help[name] = help_text
+
+    def describe(self, name: str, help_text: str):
+        self._help[name] = help_text
+
+    @staticmethod
+    def _labels(labels: tuple, extra: str = "") -> str:
+        parts = []
+        for k, v in labels:
+            v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            parts.append(f'{k}="{v}"')
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def _quantile(self, hist: List[float], q: float) -> float:
+        """Верхняя граница корзины, в которую попадает квантиль q"""
+        total = sum(hist[:-1])
+        seen = 0
+        for i, count in enumerate(hist[:-1]):
+            seen += count
+            if seen >= q * total:
+                return self.BUCKETS[i] if i < len(self.BUCKETS) else float("inf")
+        return float("inf")
+
+    def snapshot(self) -> Tuple[Dict, Dict]:
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {k: list(v) for k, v in self._histograms.items()}
+        return counters, histograms
+
+    def render_prometheus(self) -> str:
+        counters, histograms = self.snapshot()
+        lines = []
+        seen = set()
+
+        def header(name: str, kind: str):
+            if name in seen:
+                return
+            seen.add(name)
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(counters.items()):
+            header(name, "counter")
+            lines.append(f"{name}{self._labels(labels)} {value:g}")
+
+        for (name, labels), hist in sorted(histograms.items()):
+            header(name, "histogram")
+            cumulative = 0
+            for i, bound in enumerate(self.BUCKETS):
+                cumulative += hist[i]
+                le = self._labels(labels, 'le="%g"' % bound)
+                lines.append(f"{name}_bucket{le} {cumulative}")
+            cumulative += hist[len(self.BUCKETS)]
+            le = self._labels(labels, 'le="+Inf"')
+            lines.append(f"{name}_bucket{le} {cumulative}")
+            lines.append(f"{name}_sum{self._labels(labels)} {hist[-1]:.6f}")
+            lines.append(f"{name}_count{self._labels(labels)} {cumulative}")
+
+        for name, fn in sorted(self._gauges.items()):
+            header(name, "gauge")
+            try:
+                lines.append(f"{name} {fn():g}")
+            except Exception:
+                continue
+
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """Краткая сводка для /metrics"""
+        counters, histograms = self.snapshot()
+        lines = ["📈 **МЕТРИКИ**\n"]
+
+        def section(title: str, name: str, label: Optional[str] = None):
+            # Метрика без меток (label=None) — одна строка «все»
+            rows = sorted((dict(labels).get(label, "—") if label else "все", hist)
+                          for (n, labels), hist in histograms.items() if n == name)
+            if not rows:
+                return
+            lines.append(f"**{title}**")
+            for key, hist in rows:
+                count = sum(hist[:-1])
+                avg_ms = hist[-1] / count * 1000 if count else 0
+                p95_ms = self._quantile(hist, 0.95) * 1000
+                lines.append(f"• `{key}`: {count} | ср. {avg_ms:.1f}мс | p95 ≤{p95_ms:g}мс")
+
+        section("Команды", "alpha_command_latency_seconds", "command")
+        section("SQL (Database)", "alpha_sql_latency_seconds", "method")
+        section("Отправка в Telegram", "alpha_telegram_reply_seconds", "kind")
+        section("Ожидание блокировки записи", "alpha_db_lock_wait_seconds")
+
+        for name, fn in sorted(self._gauges.items()):
+            try:
+                lines.append(f"• {name}: {fn():g}")
+            except Exception:
+                continue
+        return "\n".join(lines)
+
+
+METRICS = Metrics()
+METRICS.describe("alpha_commands_total", "Обработано команд")
+METRICS.describe("alpha_offhours_skipped_total", "Команды чтения из пачки вне рабочих часов, оставленные без ответа")
+METRICS.describe("alpha_command_latency_seconds", "Время AlphaTrackerBot.handle_command")
+METRICS.describe("alpha_sql_latency_seconds", "Время методов Database")
+METRICS.describe("alpha_telegram_reply_seconds", "Время отправки сообщений в Telegram")
+METRICS.describe("alpha_db_lock_wait_seconds", "Ожидание BEGIN IMMEDIATE (блокировка записи SQLite)")
+
+
+def start_metrics_exporter(file_path: Optional[str] = METRICS_FILE, port: Optional[str] = METRICS_PORT):
+    """Фоновая выгрузка метрик: периодически в файл и/или по HTTP на 127.0.0.1:port/metrics"""
+    if file_path:
+        def write_loop():
+            while True:
+                tmp = f"{file_path}.tmp"
+                try:
+                    with open(tmp, "w", encoding="utf-8") as f:
+                        f.write(METRICS.render_prometheus())
+                    os.replace(tmp, file_path)
+                except OSError as e:
+                    print(f"❌ Не удалось записать метрики: {e}")
+                time.sleep(METRICS_FILE_INTERVAL_SEC)
+
+        threading.Thread(target=write_loop, name="metrics-file", daemon=True).start()
+        print(f"📈 Метрики пишутся в {file_path}")
+
+    if port:
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = METRICS.render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", int(port)), MetricsHandler)
+        threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+        print(f"📈 Метрики: http://127.0.0.1:{port}/metrics")
+
+
+def sql_timed(method):
+    """Замер длительности метода Database в alpha_sql_latency_seconds"""
+    label = method.__name__
+
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            METRICS.observe("alpha_sql_latency_seconds", time.perf_counter() - start, method=label)
+    return wrapper
+
+
 # ============================================================================
 # БАЗА ДАННЫХ
 # ============================================================================
 
+class Member:
+    """Запись участника: компактная (__slots__), читается и как словарь"""
+
+    __slots__ = ("name", "ap", "refund_days", "last_gap_days", "updated_at")
+
+    def __init__(self, name: str, ap: int = 0, refund_days: Optional[List[int]] = None,
+                 last_gap_days: Optional[List[int]] = None, updated_at: Optional[str] = None):
+        self.name = name
+        self.ap = ap
+        self.refund_days = refund_days if refund_days is not None else []
+        self.last_gap_days = last_gap_days if last_gap_days is not None else [0, 0]
+        self.updated_at = updated_at
+
+    def __getitem__(self, key: str):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def get(self, key: str, default=None):
+        return getattr(self, key, default)
+
+    def to_dict(self) -> Dict:
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    def __repr__(self) -> str:
+        return f"Member({self.to_dict()!r})"
+
+
+class ScoringRules:
+    """
+    Пороги сигналов calculate_score: refund≤refund_max (+2), surplus≥surplus_min (+1),
+    rest≥rest_min (+1). Веса фиксированы — на них построены корзины CandidateIndex.
+    """
+
+    __slots__ = ("refund_max", "surplus_min", "rest_min")
+
+    def __init__(self, refund_max: int = 3, surplus_min: int = 20, rest_min: int = 7):
+        self.refund_max = refund_max
+        self.surplus_min = surplus_min
+        self.rest_min = rest_min
+
+    def __repr__(self) -> str:
+        return f"ScoringRules(refund_max={self.refund_max}, surplus_min={self.surplus_min}, rest_min={self.rest_min})"
+
+
+DEFAULT_SCORING = ScoringRules()
+
+
+def system_clock() -> datetime:
+    """Текущее время по TZ; в реплее подменяется часами из лога"""
+    return datetime.now(TZ)
+
+
 class Database:
-    def __init__(self, db_path="drops.db"):
+    def __init__(self, db_path: str = DB_PATH, seed_defaults: bool = True,
+                 clock: Callable[[], datetime] = system_clock, scoring: ScoringRules = DEFAULT_SCORING):
         self.db_path = db_path
+        # Общая база заполняется KNOWN_PARTICIPANTS/COMMISSIONED_MEMBERS, база чата — нет
+        self.seed_defaults = seed_defaults
+        # Все «сейчас» базы и бота берутся отсюда, правила score — для индекса и /plan
+        self.clock = clock
+        self.scoring = scoring
+        # Одно долгоживущее соединение на поток: без connect/close на каждый вызов
+        self._local = threading.local()
+        self._conns: List[sqlite3.Connection] = []
+        self._conns_lock = threading.Lock()
+        self._index: Optional["CandidateIndex"] = None
+        self._index_lock = threading.Lock()
+        self._commissions: Optional[Dict[str, float]] = None
+        # Поколение данных: растёт при каждой записи, по нему сверяется кэш ответов
+        self.generation = 0
+        self._generation_lock = threading.Lock()
         self.init_db()
 
-    def get_conn(self):
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
+    def get_conn(self) -> sqlite3.Connection:
+        """Соединение текущего потока (WAL, synchronous=NORMAL, кэш выражений)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.db_path,
+                timeout=30,
+                isolation_level=None,       # транзакциями управляем сами
+                check_same_thread=False,
+                cached_statements=256,      # переиспользование prepared statements
+            )
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA temp_store=MEMORY")
+            self._local.conn = conn
+            self._local.depth = 0
+            with self._conns_lock:
+                self._conns.append(conn)
         return conn
 
-    def init_db(self):
+    @contextmanager
+    def transaction(self, immediate: bool = True):
+        """
+        with db.transaction() as conn: ...
+
+        BEGIN IMMEDIATE сразу берёт блокировку записи (в WAL читатели не блокируются).
+        Вложенные вызовы присоединяются к внешней транзакции.
+        """
         conn = self.get_conn()
-        c = conn.cursor()
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield conn
+            finally:
+                self._local.depth -= 1
+            return
+
+        start = time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        if immediate:
+            # Ожидание блокировки записи (busy timeout) — растёт при конкуренции писателей
+            METRICS.observe("alpha_db_lock_wait_seconds", time.perf_counter() - start)
+        self._local.depth = 1
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            # Откаченные изменения могли попасть в индекс — перестроим лениво
+            self._index = None
+            raise
+        else:
+            conn.execute("COMMIT")
+        finally:
+            self._local.depth = 0
+
+    @property
+    def in_transaction(self) -> bool:
+        """Текущий поток внутри db.transaction()"""
+        return bool(getattr(self._local, "depth", 0))
+
+    def bump_generation(self):
+        with self._generation_lock:
+            self.generation += 1
+
+    def close(self):
+        """Закрывает все соединения пула"""
+        with self._conns_lock:
+            for conn in self._conns:
+                try:
+                    conn.close()
+                except sqlite3.Error:
+                    pass
+            self._conns.clear()
+        self._local = threading.local()
+
+    # Миграции схемы по порядку. Все идемпотентны: базы, созданные до появления
+    # schema_version, проходят их целиком без потери данных.
+    MIGRATIONS = (
+        (1, "_schema_base"),
+        (2, "_schema_members_normalized"),
+        (3, "_schema_reminders"),
+        (4, "_schema_pnl_indexes"),
+        (5, "_schema_commissions"),
+        (6, "_schema_trade_ids"),
+        (7, "_schema_drop_events_index"),
+        (8, "_schema_member_history"),
+        (9, "_schema_reservations"),
+        (10, "_schema_offhours_queue"),
+        (11, "_schema_seen_updates"),
+    )
+
+    def schema_version(self) -> int:
+        try:
+            row = self.get_conn().execute("SELECT MAX(version) FROM schema_version").fetchone()
+        except sqlite3.OperationalError:
+            return 0
+        return row[0] or 0
+
+    @sql_timed
+    def init_db(self):
+        # Быстрый путь: схема актуальна — ни одного DDL
+        if self.schema_version() == self.MIGRATIONS[-1][0]:
+            return
 
+        with self.transaction() as c:
+            c.execute("""CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                applied_at TEXT
+            )""")
+            # Перепроверяем под блокировкой записи: другой процесс мог успеть первым
+            current = c.execute("SELECT MAX(version) FROM schema_version").fetchone()[0] or 0
+            for version, method in self.MIGRATIONS:
+                if version > current:
+                    getattr(self, method)(c)
+                    c.execute("INSERT INTO schema_version (version, applied_at) VALUES (?, ?)",
+                              (version, self._now()))
+
+            # Начальное заполнение — только при первом запуске
+            if current == 0 and self.seed_defaults:
+                self.init_members()
+                c.executemany("INSERT OR IGNORE INTO commissions (member_name, share) VALUES (?, ?)",
+                              list(COMMISSIONED_MEMBERS.items()))
+
+    def _schema_base(self, c: sqlite3.Connection):
         # Члены команды
         c.execute("""CREATE TABLE IF NOT EXISTS members (
             name TEXT PRIMARY KEY,
@@ -102,122 +576,604 @@ class Database:
             created_at TEXT
         )""")
 
-        conn.commit()
-        conn.close()
+    def _schema_members_normalized(self, c: sqlite3.Connection):
+        self._migrate_members_normalized(c)
+        # Даты возврата AP — по строке на день (порядок ввода сохраняется в pos)
+        c.execute("""CREATE TABLE IF NOT EXISTS member_refunds (
+            member_name TEXT NOT NULL,
+            pos INTEGER NOT NULL,
+            days INTEGER NOT NULL,
+            PRIMARY KEY (member_name, pos)
+        )""")
+        # Индексы под предикаты score (refund≤3, rest≥7, surplus)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_member_refunds_days ON member_refunds (days)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_members_refund_min ON members (refund_min)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_members_gap_max ON members (gap_max)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_members_ap ON members (ap)")
+
+    def _schema_reminders(self, c: sqlite3.Connection):
+        # Напоминания о дропах
+        c.execute("""CREATE TABLE IF NOT EXISTS reminders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            event_id INTEGER NOT NULL,
+            fire_ts INTEGER NOT NULL,
+            offset_hours INTEGER,
+            status TEXT DEFAULT 'pending',
+            sent_at TEXT
+        )""")
+        # Частичный индекс: после рестарта читаем только ожидающие
+        c.execute("""CREATE INDEX IF NOT EXISTS idx_reminders_pending
+                     ON reminders (fire_ts) WHERE status='pending'""")
+
+    def _schema_pnl_indexes(self, c: sqlite3.Connection):
+        # Покрывающие индексы для /pnl: агрегаты читаются без обращения к таблице
+        c.execute("""CREATE INDEX IF NOT EXISTS idx_trade_reports_event
+                     ON trade_reports (event_id, member_name, created_at, gross_usd, net_usd, share_model)""")
+        c.execute("""CREATE INDEX IF NOT EXISTS idx_trade_reports_member
+                     ON trade_reports (member_name, created_at, gross_usd, net_usd, share_model)""")
+        c.execute("""CREATE INDEX IF NOT EXISTS idx_trade_reports_created
+                     ON trade_reports (created_at, member_name, gross_usd, net_usd, share_model)""")
+
+    def _schema_commissions(self, c: sqlite3.Connection):
+        # Комиссия команды по участникам (доля от net)
+        c.execute("""CREATE TABLE IF NOT EXISTS commissions (
+            member_name TEXT PRIMARY KEY,
+            share REAL NOT NULL
+        )""")
 
-        # Инициализация участников
-        self.init_members()
+    def _schema_drop_events_index(self, c: sqlite3.Connection):
+        # Выборка запланированных дропов по окну времени (/plan)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_drop_events_status_when ON drop_events (status, when_ts)")
+
+    def _schema_member_history(self, c: sqlite3.Connection):
+        # История участников: только дописывается (ввод /drop и ежедневное старение)
+        c.execute("""CREATE TABLE IF NOT EXISTS member_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            member_name TEXT NOT NULL,
+            ts INTEGER NOT NULL,
+            ap INTEGER,
+            refund_min INTEGER,
+            gap_min INTEGER,
+            gap_max INTEGER,
+            source TEXT
+        )""")
+        # «AP на момент T» — поиск по (member_name, ts) без сканирования
+        c.execute("CREATE INDEX IF NOT EXISTS idx_member_history_member_ts ON member_history (member_name, ts)")
+        # Служебные значения бота (дата последнего старения и т.п.)
+        c.execute("""CREATE TABLE IF NOT EXISTS bot_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )""")
+        # Отправная точка истории — текущее состояние
+        c.execute("""INSERT INTO member_history (member_name, ts, ap, refund_min, gap_min, gap_max, source)
+                     SELECT name, ?, ap, refund_min, gap_min, gap_max, 'snapshot' FROM members""",
+                  (self._ts(),))
+
+    def _schema_reservations(self, c: sqlite3.Connection):
+        if "capacity" not in {row["name"] for row in c.execute("PRAGMA table_info(drop_events)")}:
+            c.execute("ALTER TABLE drop_events ADD COLUMN capacity INTEGER")
+        # Подсчёт занятых мест и лист ожидания дропа
+        c.execute("CREATE INDEX IF NOT EXISTS idx_reservations_event_status ON reservations (event_id, status)")
+        # Не больше одной действующей брони участника на дроп
+        c.execute("""CREATE UNIQUE INDEX IF NOT EXISTS idx_reservations_active
+                     ON reservations (event_id, member_name) WHERE status IN ('confirmed', 'waitlist')""")
+
+    def _schema_offhours_queue(self, c: sqlite3.Connection):
+        # Команды, пришедшие вне рабочих часов: применяются пачкой в WORK_START
+        c.execute("""CREATE TABLE IF NOT EXISTS offhours_queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts INTEGER NOT NULL,
+            text TEXT NOT NULL
+        )""")
+
+    def _schema_seen_updates(self, c: sqlite3.Connection):
+        # update_id применённых команд-записей: повтор после рестарта или ретрая webhook пропускается
+        c.execute("CREATE TABLE IF NOT EXISTS seen_updates (update_id INTEGER PRIMARY KEY)")
+
+    def _schema_trade_ids(self, c: sqlite3.Connection):
+        if "trade_id" not in {row["name"] for row in c.execute("PRAGMA table_info(trade_reports)")}:
+            c.execute("ALTER TABLE trade_reports ADD COLUMN trade_id TEXT")
+        # Повтор той же продажи (рестарт, ретрай webhook, повтор очереди) не создаёт дублей
+        c.execute("""CREATE UNIQUE INDEX IF NOT EXISTS idx_trade_reports_trade_id
+                     ON trade_reports (trade_id)""")
 
     def init_members(self):
-        conn = self.get_conn()
-        c = conn.cursor()
-        for name in KNOWN_PARTICIPANTS:
-            c.execute("INSERT OR IGNORE INTO members (name, updated_at) VALUES (?, ?)",
-                     (name, self._now()))
-        conn.commit()
-        conn.close()
+        self.add_members(KNOWN_PARTICIPANTS)
+
+    @sql_timed
+    def add_members(self, names: List[str]):
+        """Добавляет участников (уже существующие пропускаются)"""
+        now = self._now()
+        with self.transaction() as c:
+            c.executemany("INSERT OR IGNORE INTO members (name, updated_at) VALUES (?, ?)",
+                          [(name, now) for name in names])
+        # Новые участники появятся в индексе при ленивой перестройке
+        self._index = None
+        self.bump_generation()
+
+    def _now(self) -> str:
+        return self.clock().isoformat()
+
+    def _ts(self) -> int:
+        return int(self.clock().timestamp())
+
+    def get_commissions(self) -> Dict[str, float]:
+        """Доли комиссии команды (кэшируются до set_commission)"""
+        commissions = self._commissions
+        if commissions is None:
+            rows = self.get_conn().execute("SELECT member_name, share FROM commissions").fetchall()
+            commissions = self._commissions = {row[0]: row[1] for row in rows}
+        return commissions
+
+    @sql_timed
+    def set_commission(self, member_name: str, share: float):
+        with self.transaction() as c:
+            c.execute("INSERT OR REPLACE INTO commissions (member_name, share) VALUES (?, ?)",
+                      (member_name, share))
+        self._commissions = None
+        self.bump_generation()
+
+    def get_candidate_index(self) -> "CandidateIndex":
+        """Индекс ранжирования; строится один раз, дальше обновляется update_member"""
+        index = self._index
+        if index is None:
+            # Снимок и установка — под блокировкой записи и _index_lock (тот же
+            # порядок, что у писателей): запись не проскочит между чтением
+            # участников и появлением индекса. Отдельный замок — потому что
+            # get_conn нового потока сам берёт _conns_lock.
+            with self.transaction(), self._index_lock:
+                if self._index is None:
+                    self._index = CandidateIndex(self.get_all_members(), self.scoring)
+                index = self._index
+        return index
+
+    def _index_upsert(self, members: List[Member]):
+        """
+        Обновляет индекс, если он уже построен. Вызывается внутри транзакции
+        записи до COMMIT: порядок обновлений индекса совпадает с порядком
+        коммитов, а откат транзакции сбрасывает индекс.
+        """
+        with self._index_lock:
+            if self._index is not None:
+                for member in members:
+                    self._index.upsert(member)
+
+    def _migrate_members_normalized(self, c: sqlite3.Connection):
+        """Старая схема: refund_days/last_gap_days в JSON → типизированные колонки + member_refunds"""
+        columns = {row["name"] for row in c.execute("PRAGMA table_info(members)")}
+        if "refund_days" not in columns:
+            return
 
-    @staticmethod
-    def _now():
-        return datetime.now(TZ).isoformat()
+        c.execute("""CREATE TABLE members_new (
+            name TEXT PRIMARY KEY,
+            ap INTEGER DEFAULT 0,
+            refund_min INTEGER,
+            gap_min INTEGER DEFAULT 0,
+            gap_max INTEGER DEFAULT 0,
+            updated_at TEXT
+        )""")
+        c.execute("""CREATE TABLE IF NOT EXISTS member_refunds (
+            member_name TEXT NOT NULL,
+            pos INTEGER NOT NULL,
+            days INTEGER NOT NULL,
+            PRIMARY KEY (member_name, pos)
+        )""")
 
-    def update_member(self, name: str, ap: int, refund_days: List[int], last_gap: Tuple[int, int]):
-        conn = self.get_conn()
-        c = conn.cursor()
-        c.execute("""UPDATE members 
-                    SET ap=?, refund_days=?, last_gap_days=?, updated_at=? 
-                    WHERE name=?""",
-                 (ap, json.dumps(refund_days), json.dumps(list(last_gap)), self._now(), name))
-        conn.commit()
-        conn.close()
-
-    def get_member(self, name: str) -> Optional[Dict]:
-        conn = self.get_conn()
-        c = conn.cursor()
-        c.execute("SELECT * FROM members WHERE name=?", (name,))
-        row = c.fetchone()
-        conn.close()
-        if row:
-            return {
-                "name": row["name"],
-                "ap": row["ap"],
-                "refund_days": json.loads(row["refund_days"]),
-                "last_gap_days": json.loads(row["last_gap_days"]),
-                "updated_at": row["updated_at"]
-            }
-        return None
+        members = []
+        refunds = []
+        for row in c.execute("SELECT * FROM members ORDER BY rowid"):
+            refund = json.loads(row["refund_days"] or "[]")
+            gap = json.loads(row["last_gap_days"] or "[0,0]") or [0, 0]
+            members.append((row["name"], row["ap"], min(refund) if refund else None,
+                            gap[0], gap[1], row["updated_at"]))
+            refunds.extend(self._refund_rows(row["name"], refund))
+
+        c.executemany("""INSERT INTO members_new (name, ap, refund_min, gap_min, gap_max, updated_at)
+                        VALUES (?, ?, ?, ?, ?, ?)""", members)
+        c.executemany("INSERT INTO member_refunds (member_name, pos, days) VALUES (?, ?, ?)", refunds)
+        c.execute("DROP TABLE members")
+        c.execute("ALTER TABLE members_new RENAME TO members")
 
-    def get_all_members(self) -> List[Dict]:
-        conn = self.get_conn()
-        c = conn.cursor()
-        c.execute("SELECT * FROM members")
-        rows = c.fetchall()
-        conn.close()
-        result = []
-        for row in rows:
-            result.append({
-                "name": row["name"],
-                "ap": row["ap"],
-                "refund_days": json.loads(row["refund_days"]),
-                "last_gap_days": json.loads(row["last_gap_days"]),
-                "updated_at": row["updated_at"]
-            })
-        return result
+    @staticmethod
+    def _refund_rows(name: str, refund_days: List[int]) -> List[Tuple[str, int, int]]:
+        return [(name, pos, days) for pos, days in enumerate(refund_days)]
 
-    def create_drop_event(self, when_ts: int, ap_threshold: int, symbol: Optional[str] = None) -> int:
-        conn = self.get_conn()
-        c = conn.cursor()
-        c.execute("""INSERT INTO drop_events (when_ts, ap_threshold, symbol, created_at)
-                    VALUES (?, ?, ?, ?)""",
-                 (when_ts, ap_threshold, symbol or "", self._now()))
-        conn.commit()
-        event_id = c.lastrowid
-        conn.close()
+    @sql_timed
+    def update_member(self, name: str, ap: int, refund_days: List[int], last_gap: Tuple[int, int]):
+        now = self._now()
+        with self.transaction() as c:
+            cur = c.execute("""UPDATE members 
+                              SET ap=?, refund_min=?, gap_min=?, gap_max=?, updated_at=? 
+                              WHERE name=?""",
+                           (ap, min(refund_days) if refund_days else None, last_gap[0], last_gap[1], now, name))
+            if cur.rowcount:
+                c.execute("DELETE FROM member_refunds WHERE member_name=?", (name,))
+                c.executemany("INSERT INTO member_refunds (member_name, pos, days) VALUES (?, ?, ?)",
+                              self._refund_rows(name, refund_days))
+                c.execute("""INSERT INTO member_history (member_name, ts, ap, refund_min, gap_min, gap_max, source)
+                            VALUES (?, ?, ?, ?, ?, ?, 'drop')""",
+                         (name, self._ts(), ap, min(refund_days) if refund_days else None,
+                          last_gap[0], last_gap[1]))
+                self._index_upsert([Member(name, ap, list(refund_days), list(last_gap), now)])
+        # Поколение — после индекса, иначе /who может закэшировать старый топ под новым номером
+        self.bump_generation()
+
+    @sql_timed
+    def update_members(self, updates: List[Dict]) -> List[str]:
+        """
+        Пакетное обновление участников одной транзакцией (executemany).
+        updates — словари как у parse_drop_command. Возвращает ненайденные имена.
+        """
+        if not updates:
+            return []
+
+        now = self._now()
+        with self.transaction() as c:
+            existing = {row["name"] for row in c.execute("SELECT name FROM members")}
+            # Повторы одного имени: применяется последняя строка
+            known = list({u["name"]: u for u in updates if u["name"] in existing}.values())
+            c.executemany("""UPDATE members 
+                            SET ap=?, refund_min=?, gap_min=?, gap_max=?, updated_at=? 
+                            WHERE name=?""",
+                         [(u["ap"], min(u["refund_days"]) if u["refund_days"] else None,
+                           u["last_gap"][0], u["last_gap"][1], now, u["name"])
+                          for u in known])
+            c.executemany("DELETE FROM member_refunds WHERE member_name=?", [(u["name"],) for u in known])
+            c.executemany("INSERT INTO member_refunds (member_name, pos, days) VALUES (?, ?, ?)",
+                          [r for u in known for r in self._refund_rows(u["name"], u["refund_days"])])
+            ts = self._ts()
+            c.executemany("""INSERT INTO member_history (member_name, ts, ap, refund_min, gap_min, gap_max, source)
+                            VALUES (?, ?, ?, ?, ?, ?, 'drop')""",
+                         [(u["name"], ts, u["ap"], min(u["refund_days"]) if u["refund_days"] else None,
+                           u["last_gap"][0], u["last_gap"][1]) for u in known])
+            self._index_upsert([Member(u["name"], u["ap"], list(u["refund_days"]), list(u["last_gap"]), now)
+                                for u in known])
+
+        self.bump_generation()
+        return [u["name"] for u in updates if u["name"] not in existing]
+
+    @sql_timed
+    def age_members(self, today: Optional[date] = None) -> int:
+        """
+        Сдвигает счётчики на прошедшие дни: «вернут» уменьшается (прошедшие
+        возвраты удаляются), «последний» растёт. Всё — несколькими UPDATE по
+        всей таблице в одной транзакции, плюс срез в member_history.
+        Дни считаются от даты прошлого запуска, поэтому повторный вызов в тот же
+        день ничего не делает, а после простоя применяются все пропущенные дни.
+        Возвращает число применённых дней.
+        """
+        today = today or self.clock().date()
+        with self.transaction() as c:
+            row = c.execute("SELECT value FROM bot_state WHERE key='aged_through'").fetchone()
+            days = (today - date.fromisoformat(row[0])).days if row else 0
+            if row and days <= 0:
+                return 0
+            if days:
+                c.execute("UPDATE member_refunds SET days = days - ?", (days,))
+                c.execute("DELETE FROM member_refunds WHERE days < 0")
+                c.execute("""UPDATE members
+                             SET gap_min = gap_min + ?, gap_max = gap_max + ?,
+                                 refund_min = (SELECT MIN(days) FROM member_refunds
+                                               WHERE member_name = members.name)""", (days, days))
+                c.execute("""INSERT INTO member_history (member_name, ts, ap, refund_min, gap_min, gap_max, source)
+                             SELECT name, ?, ap, refund_min, gap_min, gap_max, 'aging' FROM members""",
+                          (self._ts(),))
+            c.execute("INSERT OR REPLACE INTO bot_state (key, value) VALUES ('aged_through', ?)",
+                      (today.isoformat(),))
+
+        if days:
+            # Изменились все участники — индекс проще перестроить лениво
+            self._index = None
+            self.bump_generation()
+        return days
+
+    @sql_timed
+    def get_member_at(self, name: str, ts: int) -> Optional[Dict]:
+        """Состояние участника на момент ts (последняя запись истории не позже ts)"""
+        row = self.get_conn().execute("""SELECT member_name, ts, ap, refund_min, gap_min, gap_max, source
+                                         FROM member_history WHERE member_name=? AND ts <= ?
+                                         ORDER BY ts DESC, id DESC LIMIT 1""", (name, ts)).fetchone()
+        return dict(row) if row else None
+
+    @sql_timed
+    def get_member(self, name: str) -> Optional["Member"]:
+        with self.transaction(immediate=False) as c:
+            row = c.execute("SELECT name, ap, gap_min, gap_max, updated_at FROM members WHERE name=?",
+                            (name,)).fetchone()
+            if not row:
+                return None
+            refund = [r[0] for r in c.execute(
+                "SELECT days FROM member_refunds WHERE member_name=? ORDER BY pos", (name,))]
+        return Member(row[0], row[1], refund, [row[2], row[3]], row[4])
+
+    def get_all_members(self) -> List["Member"]:
+        return self.find_members()
+
+    @sql_timed
+    def find_members(self, refund_max: Optional[int] = None, rest_min: Optional[int] = None,
+                     ap_min: Optional[int] = None) -> List["Member"]:
+        """
+        Участники с фильтрами, выполняемыми в SQL по индексам:
+        refund_max — есть возврат AP не позже N дней (refund≤3 → refund_max=3),
+        rest_min — последний дроп не раньше N дней назад, ap_min — AP не меньше.
+        """
+        where = []
+        params: List[int] = []
+        if refund_max is not None:
+            where.append("refund_min <= ?")
+            params.append(refund_max)
+        if rest_min is not None:
+            where.append("gap_max >= ?")
+            params.append(rest_min)
+        if ap_min is not None:
+            where.append("ap >= ?")
+            params.append(ap_min)
+        where_sql = " WHERE " + " AND ".join(where) if where else ""
+
+        with self.transaction(immediate=False) as c:
+            rows = c.execute("SELECT name, ap, gap_min, gap_max, updated_at FROM members"
+                             + where_sql + " ORDER BY rowid", params).fetchall()
+            # Возвраты — только отобранных участников
+            refunds_sql = "SELECT member_name, days FROM member_refunds"
+            if where:
+                refunds_sql += " JOIN members ON members.name = member_refunds.member_name" + where_sql
+            refunds: Dict[str, List[int]] = {}
+            for name, days in c.execute(refunds_sql + " ORDER BY member_name, pos", params):
+                refunds.setdefault(name, []).append(days)
+
+        return [Member(row[0], row[1], refunds.get(row[0], []), [row[2], row[3]], row[4]) for row in rows]
+
+    @sql_timed
+    def create_drop_event(self, when_ts: int, ap_threshold: int, symbol: Optional[str] = None,
+                          capacity: Optional[int] = None) -> int:
+        """Создаёт дроп и в той же транзакции — его будущие напоминания"""
+        now_ts = self._ts()
+        with self.transaction() as c:
+            cur = c.execute("""INSERT INTO drop_events (when_ts, ap_threshold, symbol, capacity, created_at)
+                              VALUES (?, ?, ?, ?, ?)""",
+                           (when_ts, ap_threshold, symbol or "", capacity, self._now()))
+            event_id = cur.lastrowid
+            c.executemany("""INSERT INTO reminders (event_id, fire_ts, offset_hours)
+                            VALUES (?, ?, ?)""",
+                         [(event_id, when_ts - hours * 3600, hours)
+                          for hours in REMINDER_OFFSETS_HOURS
+                          if when_ts - hours * 3600 > now_ts])
+        self.bump_generation()
         return event_id
 
+    @sql_timed
+    def get_planned_drops(self, since_ts: int, until_ts: int) -> List[Dict]:
+        """Запланированные дропы в окне [since_ts, until_ts), по времени"""
+        rows = self.get_conn().execute("""SELECT id, when_ts, ap_threshold, symbol, status FROM drop_events
+                                          WHERE status='planned' AND when_ts >= ? AND when_ts < ?
+                                          ORDER BY when_ts, id""", (since_ts, until_ts)).fetchall()
+        return [dict(row) for row in rows]
+
+    @sql_timed
     def get_drop_event(self, event_id: int) -> Optional[Dict]:
-        conn = self.get_conn()
-        c = conn.cursor()
-        c.execute("SELECT * FROM drop_events WHERE id=?", (event_id,))
-        row = c.fetchone()
-        conn.close()
+        row = self.get_conn().execute("SELECT * FROM drop_events WHERE id=?", (event_id,)).fetchone()
         if row:
             return {
                 "id": row["id"],
                 "when_ts": row["when_ts"],
                 "ap_threshold": row["ap_threshold"],
                 "symbol": row["symbol"],
-                "status": row["status"]
+                "status": row["status"],
+                # Как COALESCE в reserve_slot: показываем ровно то, что соблюдается
+                "capacity": RESERVE_DEFAULT_SLOTS if row["capacity"] is None else row["capacity"]
             }
         return None
 
+    @sql_timed
+    def reserve_slot(self, event_id: int, member_name: str) -> Tuple[str, bool]:
+        """
+        Бронь места на дроп. Возвращает (статус, создана ли сейчас):
+        'confirmed' / 'waitlist', либо 'no_drop' / 'no_member'.
+
+        Статус выбирается в самом INSERT по числу подтверждённых броней, под
+        BEGIN IMMEDIATE — одновременные заявки выстраиваются в очередь на
+        блокировке записи, и мест не раздаётся больше capacity.
+        """
+        with self.transaction() as c:
+            drop = c.execute("SELECT COALESCE(capacity, ?) FROM drop_events WHERE id=? AND status='planned'",
+                             (RESERVE_DEFAULT_SLOTS, event_id)).fetchone()
+            if not drop:
+                return "no_drop", False
+            if not c.execute("SELECT 1 FROM members WHERE name=?", (member_name,)).fetchone():
+                return "no_member", False
+            # Повторная бронь упирается в уникальный индекс действующих и игнорируется
+            cur = c.execute("""INSERT OR IGNORE INTO reservations (event_id, member_name, status, timestamp)
+                               SELECT ?, ?, CASE WHEN COUNT(*) < ? THEN 'confirmed' ELSE 'waitlist' END, ?
+                               FROM reservations WHERE event_id=? AND status='confirmed'""",
+                            (event_id, member_name, drop[0], self._now(), event_id))
+            status = c.execute("""SELECT status FROM reservations
+                                  WHERE event_id=? AND member_name=? AND status IN ('confirmed', 'waitlist')""",
+                               (event_id, member_name)).fetchone()[0]
+        if cur.rowcount:
+            self.bump_generation()
+        return status, bool(cur.rowcount)
+
+    @sql_timed
+    def release_slot(self, event_id: int, member_name: str) -> Tuple[Optional[str], List[str]]:
+        """
+        Снимает бронь. Возвращает (прежний статус или None, кого перевели из
+        листа ожидания). Освободившиеся места достаются ожидающим по rank
+        рекомендаций дропа, без рекомендации — в порядке заявки.
+        """
+        with self.transaction() as c:
+            row = c.execute("""SELECT id, status FROM reservations
+                               WHERE event_id=? AND member_name=? AND status IN ('confirmed', 'waitlist')""",
+                            (event_id, member_name)).fetchone()
+            if not row:
+                return None, []
+            c.execute("UPDATE reservations SET status='released', timestamp=? WHERE id=?", (self._now(), row[0]))
+            promoted = self._promote_waitlist(c, event_id)
+        self.bump_generation()
+        return row[1], promoted
+
+    def _promote_waitlist(self, c: sqlite3.Connection, event_id: int) -> List[str]:
+        """Занимает свободные места дропа ожидающими (вызывается внутри транзакции)"""
+        free = c.execute("""SELECT COALESCE(d.capacity, ?) - (SELECT COUNT(*) FROM reservations r
+                                                           WHERE r.event_id = d.id AND r.status='confirmed')
+                            FROM drop_events d WHERE d.id=?""", (RESERVE_DEFAULT_SLOTS, event_id)).fetchone()
+        if not free or free[0] <= 0:
+            return []
+        rows = c.execute("""SELECT r.id, r.member_name FROM reservations r
+                            LEFT JOIN recommendations rec
+                                   ON rec.event_id = r.event_id AND rec.member_name = r.member_name
+                            WHERE r.event_id=? AND r.status='waitlist'
+                            ORDER BY rec.rank IS NULL, rec.rank, r.id
+                            LIMIT ?""", (event_id, free[0])).fetchall()
+        c.executemany("UPDATE reservations SET status='confirmed', timestamp=? WHERE id=?",
+                      [(self._now(), row[0]) for row in rows])
+        return [row[1] for row in rows]
+
+    @sql_timed
+    def get_reservations(self, event_id: int) -> List[Dict]:
+        """Действующие брони дропа: подтверждённые, затем лист ожидания в порядке продвижения"""
+        rows = self.get_conn().execute("""SELECT r.member_name, r.status FROM reservations r
+                                          LEFT JOIN recommendations rec
+                                                 ON rec.event_id = r.event_id AND rec.member_name = r.member_name
+                                          WHERE r.event_id=? AND r.status IN ('confirmed', 'waitlist')
+                                          ORDER BY r.status, rec.rank IS NULL, rec.rank, r.id""",
+                                       (event_id,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def get_state(self, key: str) -> Optional[str]:
+        row = self.get_conn().execute("SELECT value FROM bot_state WHERE key=?", (key,)).fetchone()
+        return row[0] if row else None
+
+    @sql_timed
+    def set_state(self, key: str, value: str):
+        with self.transaction() as c:
+            c.execute("INSERT OR REPLACE INTO bot_state (key, value) VALUES (?, ?)", (key, value))
+
+    @sql_timed
+    def claim_updates(self, update_ids: List[int]) -> List[int]:
+        """
+        Отмечает update_id обработанными и возвращает встреченные впервые.
+        Вызывается в одной транзакции с записью команды — тогда повтор
+        обновления не применится дважды, а откат вернёт его в работу.
+        """
+        if not update_ids:
+            return []
+        with self.transaction() as c:
+            fresh = [uid for uid in update_ids
+                     if c.execute("INSERT OR IGNORE INTO seen_updates (update_id) VALUES (?)", (uid,)).rowcount]
+            c.execute("DELETE FROM seen_updates WHERE update_id < ?", (max(update_ids) - SEEN_UPDATES_KEEP,))
+        return fresh
+
+    @sql_timed
+    def enqueue_offhours(self, text: str) -> int:
+        """Откладывает команду до рабочих часов; возвращает длину очереди"""
+        with self.transaction() as c:
+            c.execute("INSERT INTO offhours_queue (ts, text) VALUES (?, ?)", (self._ts(), text))
+            return c.execute("SELECT COUNT(*) FROM offhours_queue").fetchone()[0]
+
+    @sql_timed
+    def get_offhours_queue(self) -> List[Dict]:
+        rows = self.get_conn().execute("SELECT id, ts, text FROM offhours_queue ORDER BY id").fetchall()
+        return [dict(row) for row in rows]
+
+    @sql_timed
+    def delete_offhours(self, max_id: int):
+        with self.transaction() as c:
+            c.execute("DELETE FROM offhours_queue WHERE id <= ?", (max_id,))
+
+    @sql_timed
+    def get_pending_reminders(self, event_id: Optional[int] = None) -> List[Dict]:
+        """Ожидающие напоминания (по частичному индексу, без чтения истории)"""
+        sql = """SELECT r.id, r.event_id, r.fire_ts, r.offset_hours,
+                        e.when_ts, e.ap_threshold, e.symbol
+                 FROM reminders r JOIN drop_events e ON e.id = r.event_id
+                 WHERE r.status='pending'"""
+        params: tuple = ()
+        if event_id is not None:
+            sql += " AND r.event_id=?"
+            params = (event_id,)
+        rows = self.get_conn().execute(sql + " ORDER BY r.fire_ts", params).fetchall()
+        return [dict(row) for row in rows]
+
+    @sql_timed
+    def mark_reminders(self, reminder_ids: List[int], status: str = "sent"):
+        """Отмечает пачку напоминаний одной транзакцией"""
+        if not reminder_ids:
+            return
+        now = self._now()
+        with self.transaction() as c:
+            c.executemany("UPDATE reminders SET status=?, sent_at=? WHERE id=?",
+                          [(status, now, rid) for rid in reminder_ids])
+
+    @sql_timed
     def save_recommendations(self, event_id: int, recs: List[Tuple[str, int, str, int]]):
-        conn = self.get_conn()
-        c = conn.cursor()
-        c.execute("DELETE FROM recommendations WHERE event_id=?", (event_id,))
-        for member_name, score, signals, rank in recs:
-            c.execute("""INSERT INTO recommendations 
-                        (event_id, member_name, score, signals, rank)
-                        VALUES (?, ?, ?, ?, ?)""",
-                     (event_id, member_name, score, signals, rank))
-        conn.commit()
-        conn.close()
-
-    def create_trade_report(self, event_id: int, member_name: str, asset: str, qty: float,
-                           sell_price: float, fees_usd: float):
+        with self.transaction() as c:
+            c.execute("DELETE FROM recommendations WHERE event_id=?", (event_id,))
+            c.executemany("""INSERT INTO recommendations 
+                            (event_id, member_name, score, signals, rank)
+                            VALUES (?, ?, ?, ?, ?)""",
+                         [(event_id, member_name, score, signals, rank)
+                          for member_name, score, signals, rank in recs])
+
+    def _trade_row(self, event_id: int, member_name: str, asset: str, qty: float,
+                   sell_price: float, fees_usd: float, trade_id: Optional[str] = None) -> tuple:
         gross = qty * sell_price
         net = gross - fees_usd
-        share_model = COMMISSIONED_MEMBERS.get(member_name, 0.0)
-
-        conn = self.get_conn()
-        c = conn.cursor()
-        c.execute("""INSERT INTO trade_reports 
-                    (event_id, member_name, asset, qty, sell_price, gross_usd, fees_usd, net_usd, share_model, created_at)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                 (event_id, member_name, asset, qty, sell_price, gross, fees_usd, net, share_model, self._now()))
-        conn.commit()
-        conn.close()
-
+        share_model = self.get_commissions().get(member_name, 0.0)
+        return (trade_id or uuid.uuid4().hex, event_id, member_name, asset, qty, sell_price,
+                gross, fees_usd, net, share_model, self._now())
+
+    def record_trade(self, event_id: int, member_name: str, asset: str, qty: float,
+                     sell_price: float, fees_usd: float, trade_id: Optional[str] = None):
+        """
+        Продажа с ключом trade_id, производным от источника (update Telegram,
+        строка очереди): повторная запись той же продажи — пустая операция.
+        Внутри handle_update попадает в одну транзакцию с отметкой update_id.
+        """
+        self.insert_trade_reports([self._trade_row(event_id, member_name, asset, qty, sell_price, fees_usd,
+                                                   trade_id)])
+
+    @sql_timed
+    def insert_trade_reports(self, rows: List[tuple]):
+        """Пачка строк (как у _trade_row) одной транзакцией; повторы trade_id пропускаются"""
+        with self.transaction() as c:
+            c.executemany("""INSERT OR IGNORE INTO trade_reports 
+                            (trade_id, event_id, member_name, asset, qty, sell_price, gross_usd, fees_usd,
+                             net_usd, share_model, created_at)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", rows)
+        self.bump_generation()
+
+    @sql_timed
+    def get_pnl(self, event_id: Optional[int] = None, member_name: Optional[str] = None,
+                since: Optional[str] = None) -> List[Dict]:
+        """
+        Выплаты по участникам: сделки, gross, net, доля участника и комиссия команды.
+        Считается агрегатами SQL по покрывающим индексам trade_reports.
+        """
+        where = []
+        params: list = []
+        if event_id is not None:
+            where.append("event_id = ?")
+            params.append(event_id)
+        if member_name is not None:
+            where.append("member_name = ?")
+            params.append(member_name)
+        if since is not None:
+            where.append("created_at >= ?")
+            params.append(since)
+
+        sql = """SELECT member_name,
+                        COUNT(*) AS trades,
+                        SUM(gross_usd) AS gross_usd,
+                        SUM(net_usd) AS net_usd,
+                        SUM(net_usd * (1 - share_model)) AS payout_usd,
+                        SUM(net_usd * share_model) AS team_usd
+                 FROM trade_reports"""
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " GROUP BY member_name ORDER BY payout_usd DESC"
+        return [dict(row) for row in self.get_conn().execute(sql, params)]
+
+    @sql_timed
     def get_stats(self) -> str:
         members = self.get_all_members()
         if not members:
@@ -237,68 +1193,324 @@ class Database:
 # ПРИОРИТИЗАЦИЯ (SCORE)
 # ============================================================================
 
-def calculate_score(member: Dict, ap_threshold: int) -> Tuple[int, str]:
+def calculate_score(member: Dict, ap_threshold: int, rules: ScoringRules = DEFAULT_SCORING) -> Tuple[int, str]:
     """
     Возвращает (score, signals_text)
     
     +2 — если хотя бы одна дата возврата AP ≤ 3 дней
     +1 — если AP ≥ (порог + 20)
     +1 — если последний дроп ≥ 7 дней назад
+    (пороги 3/20/7 — по умолчанию, задаются rules)
     """
     score = 0
     signals = []
 
     # Проверка refund_days
     refund_days = member.get("refund_days", [])
-    if refund_days and min(refund_days) <= 3:
+    if refund_days and min(refund_days) <= rules.refund_max:
         score += 2
-        signals.append(f"refund≤3")
+        signals.append(f"refund≤{rules.refund_max}")
 
     # Проверка AP
     ap = member.get("ap", 0)
-    if ap >= ap_threshold + 20:
+    if ap >= ap_threshold + rules.surplus_min:
         score += 1
-        signals.append(f"surplus≥20")
+        signals.append(f"surplus≥{rules.surplus_min}")
 
     # Проверка last_gap
     gap = member.get("last_gap_days", [0, 0])
-    if gap and gap[1] >= 7:
+    if gap and gap[1] >= rules.rest_min:
         score += 1
-        signals.append(f"rest≥7")
+        signals.append(f"rest≥{rules.rest_min}")
 
     signals_text = ", ".join(signals) if signals else "—"
     return min(score, 4), signals_text
 
 
+class CandidateIndex:
+    """
+    Инкрементальный индекс кандидатов для get_top_candidates.
+
+    Score раскладывается на часть, не зависящую от порога (refund≤3 → +2,
+    rest≥7 → +1), и surplus≥20, зависящий только от AP. Участники лежат в
+    четырёх корзинах по базовому score, каждая отсортирована по ключу
+    (-AP, min(refund), -max(gap)). Для порога T «surplus»-участники корзины —
+    это её префикс (AP ≥ T+20), поэтому топ-N собирается из префиксов и
+    суффиксов корзин бинарным поиском, без полного прохода и сортировки.
+    """
+
+    def __init__(self, members: List[Dict], rules: ScoringRules = DEFAULT_SCORING):
+        self.rules = rules
+        self._lock = threading.Lock()
+        self._buckets: List[List[tuple]] = [[] for _ in range(4)]
+        self._entries: Dict[str, Tuple[int, tuple]] = {}
+        self._members: Dict[str, Dict] = {}
+        self._seq: Dict[str, int] = {}
+        for m in members:
+            self._insert(m)
+
+    def _base_score(self, member: Dict) -> int:
+        base = 0
+        refund_days = member.get("refund_days", [])
+        if refund_days and min(refund_days) <= self.rules.refund_max:
+            base += 2
+        gap = member.get("last_gap_days", [0, 0])
+        if gap and gap[1] >= self.rules.rest_min:
+            base += 1
+        return base
+
+    def _insert(self, member: Dict):
+        name = member["name"]
+        # Порядковый номер сохраняет порядок строк таблицы при равных ключах
+        seq = self._seq.setdefault(name, len(self._seq))
+        refund = member["refund_days"]
+        gap = member["last_gap_days"]
+        key = (
+            -member["ap"],
+            min(refund) if refund else 999,
+            -max(gap) if gap else 0,
+            seq,
+            name,
+        )
+        base = self._base_score(member)
+        insort(self._buckets[base], key)
+        self._entries[name] = (base, key)
+        self._members[name] = member
+
+    def _remove(self, name: str):
+        entry = self._entries.pop(name, None)
+        if entry is None:
+            return
+        base, key = entry
+        bucket = self._buckets[base]
+        del bucket[bisect_left(bucket, key)]
+        del self._members[name]
+
+    def upsert(self, member: Dict):
+        with self._lock:
+            self._remove(member["name"])
+            self._insert(member)
+
+    def remove(self, name: str):
+        with self._lock:
+            self._remove(name)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _top_locked(self, ap_threshold: int, limit: int) -> List[Dict]:
+        # В корзине отсортировано по -AP: AP ≥ T+surplus — это первые split элементов
+        probe = (-(ap_threshold + self.rules.surplus_min) + 1,)
+        splits = [bisect_left(bucket, probe) for bucket in self._buckets]
+
+        # score 4: surplus из корзины 3; score s: surplus из s-1, затем остальные из s
+        segments = [(3, 0, splits[3])]
+        for base in (2, 1, 0):
+            segments.append((base, 0, splits[base]))
+            segments.append((base + 1, splits[base + 1], len(self._buckets[base + 1])))
+        segments.append((0, splits[0], len(self._buckets[0])))
+
+        result = []
+        for base, lo, hi in segments:
+            for key in self._buckets[base][lo:min(hi, lo + limit - len(result))]:
+                result.append(self._members[key[-1]])
+            if len(result) >= limit:
+                break
+        return result
+
+    def top(self, ap_threshold: int, limit: int = 3) -> List[Dict]:
+        """Топ-N участников для порога (в порядке get_top_candidates)"""
+        with self._lock:
+            return self._top_locked(ap_threshold, limit)
+
+    def top_many(self, thresholds: List[int], limit: int = 3) -> Dict[int, List[Dict]]:
+        """Топ-N сразу для набора порогов за один снимок индекса"""
+        with self._lock:
+            return {t: self._top_locked(t, limit) for t in thresholds}
+
+
+def _candidate_entry(member: Dict, score: int, signals: str) -> Dict:
+    """Строка кандидата для /who, /newdrop и /plan"""
+    return {
+        "name": member["name"],
+        "ap": member["ap"],
+        "refund_days": member["refund_days"],
+        "last_gap_days": member["last_gap_days"],
+        "score": score,
+        "signals": signals
+    }
+
+
 def get_top_candidates(db: Database, ap_threshold: int, limit: int = 3) -> List[Dict]:
     """Возвращает топ-N кандидатов по score"""
-    members = db.get_all_members()
-    
-    scored = []
-    for m in members:
-        score, signals = calculate_score(m, ap_threshold)
-        scored.append({
-            "name": m["name"],
-            "ap": m["ap"],
-            "refund_days": m["refund_days"],
-            "last_gap_days": m["last_gap_days"],
-            "score": score,
-            "signals": signals
-        })
-
     # Сортировка: score (DESC) → AP (DESC) → min(refund_days) → max(last_gap)
-    scored.sort(key=lambda x: (
-        -x["score"],
-        -x["ap"],
-        min(x["refund_days"]) if x["refund_days"] else 999,
-        -max(x["last_gap_days"]) if x["last_gap_days"] else 0
-    ))
+    # Порядок поддерживает CandidateIndex, здесь считаются только сигналы топ-N
+    top = []
+    for m in db.get_candidate_index().top(ap_threshold, limit):
+        top.append(_candidate_entry(m, *calculate_score(m, ap_threshold, db.scoring)))
 
     # Сохраняем в БД
-    recs = [(m["name"], m["score"], m["signals"], i + 1) for i, m in enumerate(scored[:limit])]
+    recs = [(m["name"], m["score"], m["signals"], i + 1) for i, m in enumerate(top)]
     # db.save_recommendations(event_id, recs)  # если нужно
 
-    return scored[:limit]
+    return top
+
+
+def get_top_candidates_sweep(db: Database, thresholds: List[int], limit: int = 3) -> Dict[int, List[Dict]]:
+    """Топ-N кандидатов для каждого порога из списка (один проход по индексу)"""
+    result = {}
+    for threshold, members in db.get_candidate_index().top_many(thresholds, limit).items():
+        result[threshold] = [_candidate_entry(m, *calculate_score(m, threshold, db.scoring)) for m in members]
+    return result
+
+
+class MinCostFlow:
+    """Поток минимальной стоимости: последовательные кратчайшие пути (Дейкстра с потенциалами)"""
+
+    def __init__(self, n: int):
+        self.n = n
+        # Ребро: [куда, остаток пропускной способности, стоимость, индекс обратного ребра]
+        self.graph: List[List[list]] = [[] for _ in range(n)]
+
+    def add_edge(self, u: int, v: int, cap: int, cost: int) -> list:
+        edge = [v, cap, cost, len(self.graph[v])]
+        self.graph[u].append(edge)
+        self.graph[v].append([u, 0, -cost, len(self.graph[u]) - 1])
+        return edge
+
+    def _initial_potentials(self, source: int) -> List[float]:
+        # Bellman-Ford: отрицательные стоимости есть только на исходной сети без циклов
+        inf = float("inf")
+        h = [inf] * self.n
+        h[source] = 0
+        for _ in range(self.n):
+            changed = False
+            for u in range(self.n):
+                if h[u] == inf:
+                    continue
+                for v, cap, cost, _ in self.graph[u]:
+                    if cap > 0 and h[u] + cost < h[v]:
+                        h[v] = h[u] + cost
+                        changed = True
+            if not changed:
+                break
+        return [0 if x == inf else x for x in h]
+
+    def solve(self, source: int, sink: int) -> Tuple[int, int]:
+        """
+        Наращивает поток, пока очередной путь уменьшает стоимость.
+        Возвращает (поток, стоимость).
+        """
+        inf = float("inf")
+        h = self._initial_potentials(source)
+        flow = cost = 0
+        while True:
+            dist = [inf] * self.n
+            prev: List[Optional[Tuple[int, int]]] = [None] * self.n
+            dist[source] = 0
+            heap = [(0, source)]
+            while heap:
+                d, u = heapq.heappop(heap)
+                if d > dist[u]:
+                    continue
+                for i, (v, cap, c, _) in enumerate(self.graph[u]):
+                    if cap > 0:
+                        nd = d + c + h[u] - h[v]
+                        if nd < dist[v]:
+                            dist[v] = nd
+                            prev[v] = (u, i)
+                            heapq.heappush(heap, (nd, v))
+            if dist[sink] == inf:
+                break
+            for v in range(self.n):
+                if dist[v] < inf:
+                    h[v] += dist[v]
+            path_cost = h[sink] - h[source]
+            if path_cost >= 0:
+                break
+
+            push = inf
+            v = sink
+            while v != source:
+                u, i = prev[v]
+                push = min(push, self.graph[u][i][1])
+                v = u
+            v = sink
+            while v != source:
+                u, i = prev[v]
+                edge = self.graph[u][i]
+                edge[1] -= push
+                self.graph[v][edge[3]][1] += push
+                v = u
+            flow += push
+            cost += push * path_cost
+        return flow, cost
+
+
+def plan_drop_assignments(members: List[Dict], drops: List[Dict], slots: int = PLAN_SLOTS_PER_DROP,
+                          ap_spent: int = AP_SPENT_PER_DROP,
+                          max_drops: int = PLAN_MAX_DROPS_PER_MEMBER,
+                          rules: ScoringRules = DEFAULT_SCORING) -> Dict[int, List[Dict]]:
+    """
+    Распределяет участников по дропам как задачу потока минимальной стоимости.
+
+    Участник может попасть на дроп, только если его AP ≥ порога. Выгода пары —
+    score из calculate_score (×100) плюс небольшой бонус за точное попадание в
+    порог: участники с большим запасом AP остаются для высоких порогов.
+    Сколько дропов участник потянет, оценивается по AP с учётом ap_spent за
+    каждый, не больше max_drops; каждый следующий дроп того же участника
+    штрафуется PLAN_REPEAT_PENALTY, чтобы нагрузка распределялась по команде.
+    Возвращает {event_id: [кандидат, ...]} в порядке убывания score.
+    """
+    if not drops or not members:
+        return {d["id"]: [] for d in drops}
+
+    # Кандидаты дропа: достаточно лучших slots × len(drops) по выгоде. Если участник ниже,
+    # среди тех, кто выше, всегда найдётся никуда не назначенный — замена не ухудшит план.
+    keep = slots * len(drops)
+    candidates: Dict[int, List[tuple]] = {}
+    for j, d in enumerate(drops):
+        threshold = d["ap_threshold"]
+        pairs = []
+        for i, m in enumerate(members):
+            if m["ap"] < threshold:
+                continue
+            score, signals = calculate_score(m, threshold, rules)
+            benefit = 1000 + score * 100 + max(0, 50 - (m["ap"] - threshold))
+            pairs.append((benefit, -i, score, signals))
+        for benefit, neg_i, score, signals in heapq.nlargest(keep, pairs):
+            candidates.setdefault(-neg_i, []).append((j, benefit, score, signals))
+
+    min_threshold = min(d["ap_threshold"] for d in drops)
+    used = sorted(candidates)
+    source = 0
+    member_base = 1
+    drop_base = member_base + len(used)
+    sink = drop_base + len(drops)
+    net = MinCostFlow(sink + 1)
+
+    pair_edges = []
+    for node, i in enumerate(used, member_base):
+        m = members[i]
+        capacity = min(max_drops, len(candidates[i]), 1 + (m["ap"] - min_threshold) // max(ap_spent, 1))
+        for k in range(capacity):
+            net.add_edge(source, node, 1, k * PLAN_REPEAT_PENALTY)
+        for j, benefit, score, signals in candidates[i]:
+            edge = net.add_edge(node, drop_base + j, 1, -benefit)
+            pair_edges.append((edge, m, j, score, signals))
+
+    for j in range(len(drops)):
+        net.add_edge(drop_base + j, sink, slots, 0)
+
+    net.solve(source, sink)
+
+    plan: Dict[int, List[Dict]] = {d["id"]: [] for d in drops}
+    for edge, m, j, score, signals in pair_edges:
+        if edge[1] == 0:
+            plan[drops[j]["id"]].append(_candidate_entry(m, score, signals))
+    for assigned in plan.values():
+        assigned.sort(key=lambda x: (-x["score"], -x["ap"]))
+    return plan
 
 
 # ============================================================================
@@ -330,12 +1542,38 @@ def parse_drop_command(text: str) -> Optional[Dict]:
     }
 
 
-def parse_newdrop_command(text: str) -> Optional[Dict]:
+def parse_drop_lines(text: str) -> Tuple[List[Tuple[int, Dict]], List[Tuple[int, str]]]:
+    """
+    Парсит многострочный /drop:
+        /drop
+        Серёга 240AP вернут 3,5 последний 5-7
+        Назар 210AP вернут 1 последний 2-8
+
+    Возвращает ([(номер_строки, parsed)], [(номер_строки, исходная_строка)] с ошибками)
+    """
+    parsed_lines = []
+    errors = []
+    for lineno, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if line.startswith("/drop"):
+            line = line[len("/drop"):].strip()
+        if not line:
+            continue
+        parsed = parse_drop_command(f"/drop {line}")
+        if parsed:
+            parsed_lines.append((lineno, parsed))
+        else:
+            errors.append((lineno, line))
+    return parsed_lines, errors
+
+
+def parse_newdrop_command(text: str, now: Optional[datetime] = None) -> Optional[Dict]:
     """
-    Парсит /newdrop завтра 14:00 порог 200 [CORL]
+    Парсит /newdrop завтра 14:00 порог 200 [мест 5] [CORL]
     или /newdrop 16:30 порог 210 CORL
     """
-    pattern = r"/newdrop\s+(?:(завтра|сегодня)\s+)?(\d{1,2}):(\d{2})\s+порог\s+(\d+)(?:\s+(.+))?$"
+    pattern = (r"/newdrop\s+(?:(завтра|сегодня)\s+)?(\d{1,2}):(\d{2})\s+порог\s+(\d+)"
+               r"(?:\s+мест\s+(\d+))?(?:\s+(.+))?$")
     match = re.search(pattern, text)
     
     if not match:
@@ -345,9 +1583,12 @@ def parse_newdrop_command(text: str) -> Optional[Dict]:
     hour = int(match.group(2))
     minute = int(match.group(3))
     threshold = int(match.group(4))
-    symbol = match.group(5) or ""
+    capacity = int(match.group(5)) if match.group(5) else None
+    if capacity is not None and capacity < 1:
+        return None
+    symbol = match.group(6) or ""
 
-    now = datetime.now(TZ)
+    now = now or datetime.now(TZ)
     if day_str == "завтра":
         target_date = now + timedelta(days=1)
     else:
@@ -360,6 +1601,7 @@ def parse_newdrop_command(text: str) -> Optional[Dict]:
         "when_ts": when_ts,
         "ap_threshold": threshold,
         "symbol": symbol.strip(),
+        "capacity": capacity,
         "datetime": target_dt
     }
 
@@ -389,62 +1631,913 @@ def parse_sold_command(text: str) -> Optional[Dict]:
     }
 
 
+def parse_pnl_command(text: str, now: Optional[datetime] = None) -> Optional[Dict]:
+    """
+    Парсит /pnl [ID дропа | Имя | сегодня | неделя | месяц | Nд]
+    """
+    match = re.search(r"/pnl(?:\s+(.+))?$", text)
+    if not match:
+        return None
+
+    arg = (match.group(1) or "").strip()
+    if not arg:
+        return {"label": "за всё время"}
+    if arg.isdigit():
+        return {"event_id": int(arg), "label": f"дроп ID {arg}"}
+
+    today = (now or datetime.now(TZ)).replace(hour=0, minute=0, second=0, microsecond=0)
+    periods = {"сегодня": 0, "неделя": 6, "месяц": 29}
+    days_match = re.fullmatch(r"(\d+)\s*д(?:н(?:я|ей))?", arg)
+    if arg in periods or days_match:
+        days = periods[arg] if arg in periods else max(int(days_match.group(1)) - 1, 0)
+        since = today - timedelta(days=days)
+        return {"since": since.isoformat(), "label": f"с {since.strftime('%d.%m')}"}
+
+    return {"member_name": arg, "label": arg}
+
+
+def parse_plan_command(text: str, now: Optional[datetime] = None) -> Optional[Dict]:
+    """
+    Парсит /plan [сегодня|завтра|Nч] [мест N] [расход N]
+    Без периода — ближайшие 24 часа.
+    """
+    pattern = r"/plan(?:\s+(сегодня|завтра|\d+\s*ч))?(?:\s+мест\s+(\d+))?(?:\s+расход\s+(\d+))?\s*$"
+    match = re.search(pattern, text)
+    if not match:
+        return None
+
+    now = now or datetime.now(TZ)
+    period = (match.group(1) or "").replace(" ", "")
+    if period == "сегодня":
+        since = now
+        until = now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    elif period == "завтра":
+        since = now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+        until = since + timedelta(days=1)
+    else:
+        since = now
+        until = now + timedelta(hours=int(period[:-1]) if period else 24)
+
+    return {
+        "since_ts": int(since.timestamp()),
+        "until_ts": int(until.timestamp()),
+        "slots": int(match.group(2) or PLAN_SLOTS_PER_DROP),
+        "ap_spent": int(match.group(3) or AP_SPENT_PER_DROP)
+    }
+
+
+def parse_reserve_command(text: str) -> Optional[Dict]:
+    """
+    Парсит /reserve 12 Серёга, /release 12 Серёга и /reserve 12 (список броней)
+    """
+    match = re.search(r"/(reserve|release)\s+(\d+)(?:\s+(.+))?$", text)
+    if not match or (match.group(1) == "release" and not match.group(3)):
+        return None
+    return {
+        "event_id": int(match.group(2)),
+        "member_name": (match.group(3) or "").strip() or None
+    }
+
+
+def is_write_command(text: str) -> bool:
+    """Команда меняет данные (WRITE_COMMANDS, кроме /reserve <ID> без имени)"""
+    command = text.split(maxsplit=1)[0] if text.strip() else ""
+    if command == "/reserve":
+        parsed = parse_reserve_command(text.strip())
+        return bool(parsed and parsed["member_name"])
+    return command in WRITE_COMMANDS
+
+
+WHO_MAX_THRESHOLDS = 50
+
+
+def parse_who_command(text: str) -> Optional[Dict]:
+    """
+    Парсит /who порог 210
+    или /who порог 180-260 шаг 10
+    """
+    pattern = r"/who\s+порог\s+(\d+)(?:\s*-\s*(\d+)(?:\s+шаг\s+(\d+))?)?"
+    match = re.search(pattern, text)
+
+    if not match:
+        return None
+
+    start = int(match.group(1))
+    if match.group(2) is None:
+        return {"thresholds": [start], "is_range": False}
+
+    end = int(match.group(2))
+    step = int(match.group(3) or 10)
+    if step <= 0 or end < start:
+        return None
+
+    thresholds = list(range(start, end + 1, step))
+    if len(thresholds) > WHO_MAX_THRESHOLDS:
+        return None
+
+    return {"thresholds": thresholds, "is_range": True, "step": step}
+
+
+# ============================================================================
+# ИМПОРТ СОСТАВА (CSV)
+# ============================================================================
+
+def parse_roster_csv(path: str) -> Tuple[List[Tuple[int, Dict]], List[Tuple[int, str]]]:
+    """
+    Читает CSV состава с заголовком: name,ap,refund_days,last_gap
+        Серёга,240,"3,5",5-7
+    refund_days — числа через запятую/точку с запятой/пробел, last_gap — A-B.
+    """
+    import csv
+
+    parsed_rows = []
+    errors = []
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            lineno = reader.line_num
+            try:
+                name = (row.get("name") or "").strip()
+                if not name:
+                    raise ValueError("пустое имя")
+                ap = int(row["ap"])
+                refund = [int(x) for x in re.split(r"[,;\s]+", (row.get("refund_days") or "").strip()) if x]
+                gap_min, gap_max = (int(x) for x in (row.get("last_gap") or "0-0").split("-"))
+            except (KeyError, TypeError, ValueError) as e:
+                errors.append((lineno, f"неверные данные ({e})"))
+                continue
+            parsed_rows.append((lineno, {
+                "name": name,
+                "ap": ap,
+                "refund_days": refund,
+                "last_gap": (gap_min, gap_max)
+            }))
+    return parsed_rows, errors
+
+
+def import_roster_csv(db: Database, path: str) -> str:
+    """Импортирует CSV состава одной транзакцией, возвращает отчёт"""
+    parsed_rows, errors = parse_roster_csv(path)
+    missing = set(db.update_members([p for _, p in parsed_rows]))
+
+    updated = sum(1 for _, p in parsed_rows if p["name"] not in missing)
+    lines = [f"✅ Импортировано: {updated}"]
+    for lineno, reason in errors:
+        lines.append(f"❌ строка {lineno}: {reason}")
+    for lineno, p in parsed_rows:
+        if p["name"] in missing:
+            lines.append(f"❌ строка {lineno}: {p['name']} — участник не найден")
+    return "\n".join(lines)
+
+
+# ============================================================================
+# АНАЛИТИКА (колоночный снимок)
+# ============================================================================
+
+class ColumnarSnapshot:
+    """
+    Колоночный снимок trade_reports и drop_events для аналитики.
+
+    Каждая колонка — отдельный файл с типизированным массивом (array,
+    нативный порядок байт), строки участников/активов/тикеров закодированы
+    словарём в meta.json. export() дописывает только строки с id больше
+    последнего выгруженного. Чтение — через mmap + memoryview.cast, без
+    копирования данных в память процесса.
+    """
+
+    TABLES = {
+        "trades": {
+            "id": "q", "event_id": "q", "created_ts": "q",
+            "member_id": "i", "asset_id": "i",
+            "qty": "d", "sell_price": "d", "net_usd": "d",
+        },
+        "drops": {
+            "id": "q", "when_ts": "q", "ap_threshold": "i", "symbol_id": "i",
+        },
+    }
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.meta = self._load_meta()
+        self._maps: list = []
+        self._views: List[memoryview] = []
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _load_meta(self) -> Dict:
+        try:
+            with open(self._path("meta.json"), encoding="utf-8") as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            meta = {
+                "byteorder": sys.byteorder,
+                "rows": {table: 0 for table in self.TABLES},
+                "last_id": {table: 0 for table in self.TABLES},
+                "dicts": {"member": [], "asset": [], "symbol": []},
+            }
+        if meta["byteorder"] != sys.byteorder:
+            raise ValueError("снимок записан с другим порядком байт")
+        return meta
+
+    def _save_meta(self):
+        # Метаданные пишутся последними и атомарно: строки сверх meta["rows"] игнорируются
+        tmp = self._path("meta.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.meta, f, ensure_ascii=False)
+        os.replace(tmp, self._path("meta.json"))
+
+    def _encode(self, kind: str, value: str, lookup: Dict[str, int]) -> int:
+        code = lookup.get(value)
+        if code is None:
+            code = len(self.meta["dicts"][kind])
+            self.meta["dicts"][kind].append(value)
+            lookup[value] = code
+        return code
+
+    def _append(self, table: str, rows: List[tuple]):
+        columns = self.TABLES[table]
+        committed = self.meta["rows"][table]
+        for i, (name, typecode) in enumerate(columns.items()):
+            with open(self._path(f"{table}.{name}.bin"), "ab") as f:
+                # Отрезаем хвост от прерванной выгрузки
+                f.truncate(committed * array(typecode).itemsize)
+                array(typecode, (row[i] for row in rows)).tofile(f)
+        self.meta["rows"][table] = committed + len(rows)
+
+    def export(self, db: Database) -> Dict[str, int]:
+        """Дописывает новые строки из БД; возвращает число добавленных по таблицам"""
+        lookups = {kind: {v: i for i, v in enumerate(values)} for kind, values in self.meta["dicts"].items()}
+        conn = db.get_conn()
+
+        trades = []
+        for row in conn.execute("""SELECT id, event_id, created_at, member_name, asset, qty, sell_price, net_usd
+                                   FROM trade_reports WHERE id > ? ORDER BY id""",
+                                (self.meta["last_id"]["trades"],)):
+            trades.append((
+                row["id"], row["event_id"] or 0,
+                int(datetime.fromisoformat(row["created_at"]).timestamp()) if row["created_at"] else 0,
+                self._encode("member", row["member_name"] or "", lookups["member"]),
+                self._encode("asset", row["asset"] or "", lookups["asset"]),
+                row["qty"] or 0.0, row["sell_price"] or 0.0, row["net_usd"] or 0.0,
+            ))
+
+        drops = []
+        for row in conn.execute("""SELECT id, when_ts, ap_threshold, symbol
+                                   FROM drop_events WHERE id > ? ORDER BY id""",
+                                (self.meta["last_id"]["drops"],)):
+            drops.append((
+                row["id"], row["when_ts"], row["ap_threshold"] or 0,
+                self._encode("symbol", row["symbol"] or "", lookups["symbol"]),
+            ))
+
+        for table, rows in (("trades", trades), ("drops", drops)):
+            if rows:
+                self._append(table, rows)
+                self.meta["last_id"][table] = rows[-1][0]
+        self._save_meta()
+        return {"trades": len(trades), "drops": len(drops)}
+
+    def column(self, table: str, name: str) -> memoryview:
+        """Колонка как типизированный memoryview поверх mmap (zero-copy)"""
+        typecode = self.TABLES[table][name]
+        rows = self.meta["rows"][table]
+        if rows == 0:
+            return memoryview(array(typecode))
+        import mmap
+
+        with open(self._path(f"{table}.{name}.bin"), "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(mm)
+        view = memoryview(mm)[:rows * array(typecode).itemsize].cast(typecode)
+        self._views.append(view)
+        return view
+
+    def avg_sell_price_by_asset(self) -> Dict[str, float]:
+        """Средняя цена продажи по активу (взвешенная по количеству)"""
+        assets = self.meta["dicts"]["asset"]
+        qty_sum = [0.0] * len(assets)
+        value_sum = [0.0] * len(assets)
+        for asset_id, qty, price in zip(self.column("trades", "asset_id"),
+                                        self.column("trades", "qty"),
+                                        self.column("trades", "sell_price")):
+            qty_sum[asset_id] += qty
+            value_sum[asset_id] += qty * price
+        return {assets[i]: value_sum[i] / qty_sum[i] for i in range(len(assets)) if qty_sum[i]}
+
+    def close(self):
+        for view in self._views:
+            view.release()
+        for mm in self._maps:
+            mm.close()
+        self._views.clear()
+        self._maps.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# ============================================================================
+# РЕЗЕРВНЫЕ КОПИИ
+# ============================================================================
+
+def _copy_online(src_path: str, dst_path: str):
+    """
+    Копия через backup API шагами по BACKUP_PAGES_PER_STEP страниц. Источник
+    держит одну читающую транзакцию: в WAL она не мешает записи, и копия —
+    согласованный срез, который не перезапускается от параллельных коммитов.
+    """
+    src = sqlite3.connect(src_path, timeout=30, isolation_level=None)
+    dst = sqlite3.connect(dst_path)
+    try:
+        src.execute("BEGIN")
+        src.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        # sleep= у backup — только пауза перед повтором при BUSY/LOCKED; паузу
+        # между шагами делает progress, он вызывается после каждого шага
+        src.backup(dst, pages=BACKUP_PAGES_PER_STEP,
+                   progress=lambda status, remaining, total: time.sleep(BACKUP_STEP_SLEEP_SEC))
+        src.execute("COMMIT")
+        check = dst.execute("PRAGMA quick_check").fetchone()[0]
+        if check != "ok":
+            raise sqlite3.DatabaseError(f"копия повреждена: {check}")
+    finally:
+        dst.close()
+        src.close()
+
+
+def backup_database(db_path: str, backup_dir: str, keep: int = BACKUP_KEEP) -> str:
+    """
+    Снимает копию в backup_dir/<имя>-ГГГГММДД-ЧЧММСС-мкс-<pid>.db и оставляет
+    keep последних. Микросекунды и pid — чтобы два запуска в одну секунду
+    (плановый и ручной backup) не затирали друг друга.
+    """
+    os.makedirs(backup_dir, exist_ok=True)
+    name = os.path.splitext(os.path.basename(db_path))[0]
+    stamp = datetime.now(TZ).strftime("%Y%m%d-%H%M%S-%f")
+    path = os.path.join(backup_dir, f"{name}-{stamp}-{os.getpid()}.db")
+    tmp = f"{path}.tmp"
+
+    start = time.perf_counter()
+    try:
+        _copy_online(db_path, tmp)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    METRICS.observe("alpha_backup_seconds", time.perf_counter() - start)
+
+    for old in list_backups(db_path, backup_dir)[keep:]:
+        os.remove(old)
+    return path
+
+
+def list_backups(db_path: str, backup_dir: str) -> List[str]:
+    """Копии базы, новые первыми"""
+    if not os.path.isdir(backup_dir):
+        return []
+    name = os.path.splitext(os.path.basename(db_path))[0]
+    pattern = re.compile(rf"{re.escape(name)}-\d{{8}}-\d{{6}}-\d{{6}}-\d+\.db")
+    files = [f for f in os.listdir(backup_dir) if pattern.fullmatch(f)]
+    return [os.path.join(backup_dir, f) for f in sorted(files, reverse=True)]
+
+
+def backup_all(db_paths: List[str], backup_dir: str = BACKUP_DIR, keep: int = BACKUP_KEEP):
+    """Плановая копия всех баз; свежие (моложе BACKUP_MIN_AGE_SEC) пропускаются — рестарт не плодит копий"""
+    for db_path in db_paths:
+        backups = list_backups(db_path, backup_dir)
+        if backups and time.time() - os.path.getmtime(backups[0]) < BACKUP_MIN_AGE_SEC:
+            continue
+        try:
+            path = backup_database(db_path, backup_dir, keep)
+            print(f"💾 Копия {db_path} → {path}")
+        except (OSError, sqlite3.Error) as e:
+            METRICS.inc("alpha_backup_errors_total")
+            print(f"❌ Ошибка копии {db_path}: {e}")
+
+
+def restore_database(backup_path: str, db_path: str) -> Optional[str]:
+    """
+    Восстанавливает db_path из копии (тоже через backup API, поверх WAL).
+    Текущая база предварительно копируется в <db>.before-restore-<время>.db;
+    возвращает путь к ней (None, если базы не было).
+    """
+    src = sqlite3.connect(f"file:{backup_path}?mode=ro", uri=True)
+    try:
+        check = src.execute("PRAGMA quick_check").fetchone()[0]
+        if check != "ok":
+            raise ValueError(f"копия повреждена: {check}")
+
+        previous = None
+        if os.path.exists(db_path):
+            stamp = datetime.now(TZ).strftime("%Y%m%d-%H%M%S-%f")
+            previous = f"{os.path.splitext(db_path)[0]}.before-restore-{stamp}.db"
+            _copy_online(db_path, previous)
+
+        dst = sqlite3.connect(db_path, timeout=30)
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+    finally:
+        src.close()
+    return previous
+
+
+# ============================================================================
+# НАПОМИНАНИЯ
+# ============================================================================
+
+def format_reminders(reminders: List[Dict]) -> str:
+    """Одно сообщение на пачку сработавших напоминаний"""
+    lines = []
+    for r in sorted(reminders, key=lambda x: (x["when_ts"], x["event_id"])):
+        dt_str = datetime.fromtimestamp(r["when_ts"], TZ).strftime("%d.%m %H:%M")
+        line = f"⏰ Через {r['offset_hours']}ч дроп {dt_str} | Порог {r['ap_threshold']}AP"
+        if r["symbol"]:
+            line += f" | {r['symbol']}"
+        line += f" (ID: {r['event_id']})"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+class ReminderScheduler:
+    """
+    Планировщик напоминаний на min-куче.
+
+    Поток спит до ближайшего fire_ts (без тиков в простое), забирает все
+    наступившие напоминания разом и передаёт их пачкой в sender.
+    Состояние хранится в таблице reminders, при старте поднимаются только
+    ожидающие записи. Пропущенные во время простоя напоминания отправляются,
+    если дроп ещё не начался, иначе помечаются как skipped.
+    """
+
+    def __init__(self, db: Database, sender: Callable[[List[Dict]], None],
+                 pin: Callable[[], ContextManager] = nullcontext):
+        self.db = db
+        self.sender = sender
+        # Вход в базу на время срабатывания (у базы чата — TenantRegistry.acquire)
+        self.pin = pin
+        self._heap: List[Tuple[int, int]] = []
+        self._items: Dict[int, Dict] = {}
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self.add(self.db.get_pending_reminders())
+        self._thread = threading.Thread(target=self._run, name="reminders", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join()
+
+    def add(self, reminders: List[Dict]):
+        with self._cond:
+            for r in reminders:
+                if r["id"] in self._items:
+                    continue
+                self._items[r["id"]] = r
+                heapq.heappush(self._heap, (r["fire_ts"], r["id"]))
+            self._cond.notify()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    now = time.time()
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    self._cond.wait(self._heap[0][0] - now if self._heap else None)
+                if self._stopped:
+                    return
+
+                due = []
+                now = time.time()
+                while self._heap and self._heap[0][0] <= now:
+                    _, rid = heapq.heappop(self._heap)
+                    due.append(self._items.pop(rid))
+
+            with self.pin():
+                self._fire(due, now)
+
+    def _fire(self, due: List[Dict], now: float):
+        expired = [r for r in due if r["when_ts"] <= now]
+        ready = [r for r in due if r["when_ts"] > now]
+
+        self.db.mark_reminders([r["id"] for r in expired], status="skipped")
+        if not ready:
+            return
+
+        try:
+            self.sender(ready)
+        except Exception as e:
+            print(f"❌ Ошибка отправки напоминаний: {e}")
+            retry_ts = int(now) + REMINDER_RETRY_SEC
+            self.add([dict(r, fire_ts=retry_ts) for r in ready])
+            return
+
+        self.db.mark_reminders([r["id"] for r in ready])
+
+
+class DailyJob:
+    """
+    Запускает job раз в сутки в hour:00 по TZ (и сразу при старте — догнать
+    пропущенное за время простоя). Поток спит до следующего запуска.
+    """
+
+    def __init__(self, job: Callable[[], None], hour: int = AGING_HOUR, name: str = "daily"):
+        self.job = job
+        self.hour = hour
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def seconds_until_next(self, now: Optional[datetime] = None) -> float:
+        now = now or datetime.now(TZ)
+        run_at = now.replace(hour=self.hour, minute=0, second=0, microsecond=0)
+        if run_at <= now:
+            run_at += timedelta(days=1)
+        # Через timestamp — чтобы переход на летнее время не сдвигал запуск
+        return run_at.timestamp() - now.timestamp()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.job()
+            except Exception as e:
+                print(f"❌ Ошибка ежедневной задачи {self._thread.name}: {e}")
+            self._stop.wait(self.seconds_until_next())
+
+
+# ============================================================================
+# ЛОГ КОМАНД (реплей)
+# ============================================================================
+
+class CommandLog:
+    """Дописывает входящие команды строками {"ts", "chat_id", "text"} — вход для replay.py"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf-8")
+
+    def append(self, ts: float, chat_id: Optional[int], text: str):
+        line = json.dumps({"ts": ts, "chat_id": chat_id, "text": text}, ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def read_command_log(path: str, chat_id: Optional[int] = None) -> List[Tuple[float, str]]:
+    """Команды из лога [(ts, text)] по времени; chat_id — только один чат"""
+    commands = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if chat_id is not None and entry.get("chat_id") != chat_id:
+                continue
+            ts = entry["ts"]
+            if isinstance(ts, str):
+                ts = datetime.fromisoformat(ts).timestamp()
+            commands.append((float(ts), entry["text"]))
+    # Стабильная сортировка: одновременные команды остаются в порядке лога
+    commands.sort(key=lambda c: c[0])
+    return commands
+
+
 # ============================================================================
 # ИНТЕРФЕЙС БОТа (CLI)
 # ============================================================================
 
+class ResponseCache:
+    """
+    Кэш готовых ответов по ключу (команда, аргументы) и поколению данных БД.
+    Запись в базу увеличивает Database.generation, и старые ответы перестают совпадать.
+    """
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[tuple, Tuple[int, str]]" = OrderedDict()
+
+    def get_or_render(self, key: tuple, generation: int, render: Callable[[], str]) -> str:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == generation:
+                self._entries.move_to_end(key)
+                METRICS.inc("alpha_response_cache_total", result="hit")
+                return entry[1]
+
+        METRICS.inc("alpha_response_cache_total", result="miss")
+        response = render()
+        with self._lock:
+            self._entries[key] = (generation, response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return response
+
+
+KNOWN_COMMANDS = {"/start", "/stats", "/drop", "/newdrop", "/sold", "/who", "/pnl", "/metrics",
+                  "/addmember", "/commission", "/plan", "/reserve", "/release"}
+
+
 class AlphaTrackerBot:
-    def __init__(self):
-        self.db = Database()
+    def __init__(self, db: Optional[Database] = None):
+        self.db = db or Database()
         self.last_drop_event = None
+        self.cache = ResponseCache()
+        self.reminders: Optional[ReminderScheduler] = None
+        self.aging: Optional[DailyJob] = None
+        # Отложенные ночью команды: флаг, чтобы не ходить в БД на каждой команде
+        self.offhours: Optional[DailyJob] = None
+        self._offhours_sender: Optional[Callable[[str], None]] = None
+        self._offhours_lock = threading.Lock()
+        self._offhours_pending = bool(self.db.get_offhours_queue())
+        # Вход в базу для фоновых задач (напоминания, старение, ночная очередь).
+        # TenantRegistry подставляет acquire чата: пока задача работает, базу не вытеснят
+        self.pin: Callable[[], ContextManager] = nullcontext
+
+    def start_reminders(self, sender: Callable[[List[Dict]], None]):
+        """Запускает планировщик напоминаний (поднимает ожидающие из БД)"""
+        self.reminders = ReminderScheduler(self.db, sender, pin=self.pin)
+        self.reminders.start()
+
+    def start_aging(self):
+        """Ежедневно старит счётчики «вернут»/«последний» (и догоняет пропущенные дни)"""
+        self.aging = DailyJob(self._pinned(self.db.age_members), name="aging")
+        self.aging.start()
+
+    def start_offhours(self, sender: Callable[[str], None]):
+        """В WORK_START применяет отложенные ночью команды; итог уходит в sender"""
+        self._offhours_sender = sender
+        self.offhours = DailyJob(self._pinned(self.apply_offhours_queue), hour=WORK_START, name="offhours")
+        self.offhours.start()
+
+    def _pinned(self, job: Callable[[], object]) -> Callable[[], object]:
+        """Фоновая задача, которая держит базу открытой, пока работает"""
+        def run():
+            with self.pin():
+                return job()
+        return run
 
     def is_working_hours(self) -> bool:
-        now = datetime.now(TZ)
+        now = self.db.clock()
         return WORK_START <= now.hour < WORK_END
 
-    def handle_command(self, text: str) -> str:
-        """Основной обработчик команд"""
-        
+    def handle_command(self, text: str, trade_id: Optional[str] = None) -> str:
+        """Основной обработчик команд (с замером в METRICS); trade_id — ключ продажи для /sold"""
+        command = text.strip().split(maxsplit=1)[0] if text.strip() else ""
+        if command not in KNOWN_COMMANDS:
+            command = "other"
+
+        start = time.perf_counter()
+        try:
+            return self._dispatch(text, trade_id)
+        finally:
+            METRICS.inc("alpha_commands_total", command=command)
+            METRICS.observe("alpha_command_latency_seconds", time.perf_counter() - start, command=command)
+
+    def _dispatch(self, text: str, trade_id: Optional[str] = None) -> str:
         if not self.is_working_hours() and not text.startswith("/start") and not text.startswith("/stats"):
+            if is_write_command(text):
+                queued = self.db.enqueue_offhours(text.strip())
+                self._offhours_pending = True
+                return (f"😴 Бот отдыхает до {WORK_START}:00 ⏰\n"
+                        f"📥 Команда сохранена и выполнится в {WORK_START}:00 (в очереди: {queued})")
             return f"😴 Бот отдыхает до {WORK_START}:00 ⏰"
 
-        text = text.strip()
+        # Отложенные ночью команды — раньше новых, чтобы новые их не перетёрли
+        if self._offhours_pending:
+            self.apply_offhours_queue()
+
+        return self._execute(text.strip(), trade_id)
 
+    def _execute(self, text: str, trade_id: Optional[str] = None) -> str:
         if text == "/start":
             return self.cmd_start()
         elif text == "/stats":
-            return self.db.get_stats()
+            # Поколение читается до рендера: запись во время рендера не закэширует старый ответ
+            return self.cache.get_or_render(("/stats",), self.db.generation, self.db.get_stats)
         elif text.startswith("/drop"):
             return self.cmd_drop(text)
         elif text.startswith("/newdrop"):
             return self.cmd_newdrop(text)
         elif text.startswith("/sold"):
-            return self.cmd_sold(text)
+            return self.cmd_sold(text, trade_id)
         elif text.startswith("/who"):
-            return self.cmd_who(text)
+            key = ("/who", " ".join(text.split()))
+            return self.cache.get_or_render(key, self.db.generation, lambda: self.cmd_who(text))
+        elif text.startswith("/pnl"):
+            return self.cmd_pnl(text)
+        elif text.startswith("/plan"):
+            return self.cmd_plan(text)
+        elif text.startswith("/reserve"):
+            return self.cmd_reserve(text)
+        elif text.startswith("/release"):
+            return self.cmd_release(text)
+        elif text == "/metrics":
+            return METRICS.summary()
+        elif text.startswith("/addmember"):
+            return self.cmd_addmember(text)
+        elif text.startswith("/commission"):
+            return self.cmd_commission(text)
         else:
             return "❓ Неизвестная команда. Используй /start для справки."
 
+    def handle_update(self, update_id: int, text: str) -> Optional[str]:
+        """
+        Команда из Telegram. Запись выполняется в одной транзакции с отметкой
+        update_id: повтор того же обновления (рестарт, ретрай webhook)
+        возвращает None и ничего не меняет.
+        """
+        if not is_write_command(text):
+            return self.handle_command(text)
+        if self._offhours_pending:
+            # До своей транзакции: порядок замков как у DailyJob — _offhours_lock, потом БД
+            self.apply_offhours_queue()
+        with self.db.transaction():
+            if not self.db.claim_updates([update_id]):
+                return None
+            response = self.handle_command(text, trade_id=f"u{update_id}")
+        self.db.bump_generation()
+        return response
+
+    def handle_batch(self, items: List[Dict]) -> Optional[str]:
+        """
+        Пачка команд чата {"update_id", "ts", "text"} — например, накопившихся
+        за время рестарта. Повторы отсеиваются, остальное применяется одной
+        транзакцией со схлопыванием, как очередь на WORK_START; вне рабочих
+        часов записи откладываются в неё. Возвращает сводку (None — всё повторы).
+        """
+        if self._offhours_pending:
+            self.apply_offhours_queue()
+        with self.db.transaction():
+            fresh = set(self.db.claim_updates([item["update_id"] for item in items]))
+            items = [dict(item, trade_id=f"u{item['update_id']}") for item in items if item["update_id"] in fresh]
+            if not items:
+                return None
+
+            if not self.is_working_hours():
+                writes = [item for item in items if is_write_command(item["text"])]
+                for item in writes:
+                    queued = self.db.enqueue_offhours(item["text"])
+                    self._offhours_pending = True
+                summary = f"😴 Бот отдыхает до {WORK_START}:00 ⏰"
+                if writes:
+                    summary += f"\n📥 Сохранено команд: {len(writes)} — выполнятся в {WORK_START}:00 (в очереди: {queued})"
+                skipped = len(items) - len(writes)
+                if skipped:
+                    # Чтения ночью не выполняются и в очередь не идут — но и не пропадают молча
+                    METRICS.inc("alpha_offhours_skipped_total", skipped)
+                    summary += f"\n🚫 Без ответа: {skipped} команд(ы) чтения — повтори после {WORK_START}:00"
+                return summary
+
+            if self._offhours_pending:
+                self.apply_offhours_queue()
+            lines = self._apply_batch(items)
+        self.db.bump_generation()
+        return f"📬 **Команды, пришедшие во время перезапуска** ({len(items)})\n" + lines
+
+    def apply_offhours_queue(self) -> Optional[str]:
+        """Применяет команды, отложенные вне рабочих часов, одной транзакцией"""
+        if not self.is_working_hours():
+            return None
+        # Замки берутся в порядке _offhours_lock → БД. Внутри уже открытой транзакции
+        # ждать _offhours_lock нельзя: его может держать DailyJob, который сам ждёт
+        # нашу блокировку записи. Тогда очередь применит он.
+        if not self._offhours_lock.acquire(blocking=not self.db.in_transaction):
+            return None
+        try:
+            if not self._offhours_pending:
+                return None
+            queued = self.db.get_offhours_queue()
+            if not queued:
+                self._offhours_pending = False
+                return None
+
+            with self.db.transaction():
+                lines = self._apply_batch([dict(item, trade_id=f"q{item['id']}") for item in queued])
+                self.db.delete_offhours(queued[-1]["id"])
+                self._offhours_pending = False
+            # Изменения видны другим потокам только после COMMIT
+            self.db.bump_generation()
+        finally:
+            self._offhours_lock.release()
+
+        summary = f"☀️ **Команды, отложенные до {WORK_START}:00** ({len(queued)})\n" + lines
+        if self._offhours_sender:
+            self._offhours_sender(summary)
+        return summary
+
+    def _apply_batch(self, items: List[Dict]) -> str:
+        """
+        Выполняет пачку команд {"ts", "text", "trade_id"} (вызывается внутри
+        транзакции). Избыточные записи схлопываются: из всех /drop применяется
+        последняя строка каждого участника (один update_members), /addmember —
+        одним add_members, остальные команды выполняются по порядку поступления.
+        Возвращает текст с итогами.
+        """
+        updates: Dict[str, Dict] = {}
+        drop_lines = 0
+        new_members: List[str] = []
+        others = []
+        errors = []
+        for item in items:
+            text = item["text"]
+            command = text.split(maxsplit=1)[0]
+            METRICS.inc("alpha_commands_total", command=command if command in KNOWN_COMMANDS else "other")
+            if command == "/drop":
+                parsed_lines, bad = parse_drop_lines(text)
+                drop_lines += len(parsed_lines)
+                for _, p in parsed_lines:
+                    updates.pop(p["name"], None)
+                    updates[p["name"]] = p
+                errors.extend(f"❌ {line}" for _, line in bad)
+            elif command == "/addmember":
+                new_members.extend(n.strip() for n in text[len("/addmember"):].split(",") if n.strip())
+            else:
+                others.append(item)
+
+        replies = []
+        if new_members:
+            self.db.add_members(new_members)
+            replies.append(f"✅ В составе: {', '.join(new_members)}")
+        missing = self.db.update_members(list(updates.values()))
+        errors.extend(f"❌ {name} — участник не найден" for name in missing)
+        for item in others:
+            if item["text"].startswith("/newdrop"):
+                # «завтра» — относительно момента, когда команду прислали
+                reply = self.cmd_newdrop(item["text"], datetime.fromtimestamp(item["ts"], TZ))
+            else:
+                reply = self._execute(item["text"], item["trade_id"])
+            replies.append(reply)
+
+        result = ""
+        if updates:
+            result += f"✅ /drop: {drop_lines} строк → {len(updates) - len(missing)} участник(ов)\n"
+        result += "".join(f"\n{reply}\n" for reply in replies)
+        result += "".join(f"{line}\n" for line in errors)
+        return result.rstrip("\n")
+
     def cmd_start(self) -> str:
         return """🤖 **AlphaTrackerBot** — управление дропами
 
 **Основные команды:**
 • `/drop <Имя> <AP> вернут X,Y последний A-B` — обновить данные участника
-• `/newdrop [завтра|сегодня] HH:MM порог N [тикер]` — создать дроп
+  (можно несколько строк — по участнику на строку)
+• `/newdrop [завтра|сегодня] HH:MM порог N [мест N] [тикер]` — создать дроп
+• `/reserve <ID> <Имя>` — занять место на дроп (мест нет — лист ожидания)
+• `/release <ID> <Имя>` — снять бронь; `/reserve <ID>` — список броней
 • `/sold <Имя> <ASSET> QTYшт по PRICE$ комса FEE$` — отчёт о продаже
 • `/stats` — статистика по участникам
+• `/pnl [ID|Имя|сегодня|неделя|месяц|Nд]` — выплаты и комиссия команды
+• `/addmember Имя[, Имя2]` — добавить участников в состав
+• `/commission <Имя> 20%` — доля команды с продаж участника
+• `/metrics` — задержки команд и SQL (для админов)
 • `/who порог N` — топ-3 кандидатов на порог N
+• `/who порог A-B шаг S` — топ-3 для каждого порога из диапазона
+• `/plan [сегодня|завтра|Nч] [мест N] [расход N]` — распределить участников по дропам
 
 **Примеры:**
 /drop Серёга 240AP вернут 3,5 последний 5-7
 /newdrop завтра 14:00 порог 200 CORL
 /sold Серёга CORL 125шт по 0.80$ комса 2.5$
 /who порог 210
+/who порог 180-260 шаг 10
 
 🔗 Рабочие часы: 11:00–23:00 (Kyiv)
+Команды-записи вне рабочих часов сохраняются и выполняются в 11:00.
 """
 
     def cmd_drop(self, text: str) -> str:
+        if "\n" in text:
+            return self.cmd_drop_bulk(text)
+
         parsed = parse_drop_command(text)
         if not parsed:
             return "❌ Неверный формат. Используй:\n/drop <Имя> <AP> вернут X,Y последний A-B"
@@ -460,20 +2553,48 @@ class AlphaTrackerBot:
         gap_str = f"{gap[0]}-{gap[1]}"
         return f"✅ {name}: {ap}AP | вернут [{refund_str}] | последний [{gap_str}]"
 
-    def cmd_newdrop(self, text: str) -> str:
-        parsed = parse_newdrop_command(text)
+    def cmd_drop_bulk(self, text: str) -> str:
+        """Многострочный /drop: все участники одной транзакцией"""
+        parsed_lines, errors = parse_drop_lines(text)
+        if not parsed_lines and not errors:
+            return "❌ Неверный формат. Используй:\n/drop <Имя> <AP> вернут X,Y последний A-B"
+
+        missing = set(self.db.update_members([p for _, p in parsed_lines]))
+
+        result = []
+        for lineno, p in parsed_lines:
+            if p["name"] in missing:
+                errors.append((lineno, f"{p['name']} — участник не найден"))
+                continue
+            refund_str = ", ".join(map(str, p["refund_days"]))
+            gap = p["last_gap"]
+            result.append(f"✅ {p['name']}: {p['ap']}AP | вернут [{refund_str}] | последний [{gap[0]}-{gap[1]}]")
+
+        for lineno, line in sorted(errors):
+            result.append(f"❌ строка {lineno}: {line}")
+        return "\n".join(result)
+
+    def cmd_newdrop(self, text: str, now: Optional[datetime] = None) -> str:
+        parsed = parse_newdrop_command(text, now or self.db.clock())
         if not parsed:
-            return "❌ Неверный формат. Используй:\n/newdrop завтра 14:00 порог 200 [CORL]"
+            return "❌ Неверный формат. Используй:\n/newdrop завтра 14:00 порог 200 [мест 5] [CORL]"
 
         event_id = self.db.create_drop_event(
             parsed["when_ts"],
             parsed["ap_threshold"],
-            parsed["symbol"]
+            parsed["symbol"],
+            parsed["capacity"]
         )
         self.last_drop_event = event_id
 
-        # Получаем топ-3
+        pending = self.db.get_pending_reminders(event_id)
+        if self.reminders:
+            self.reminders.add(pending)
+
+        # Получаем топ-3 и сохраняем как рекомендации дропа
         top3 = get_top_candidates(self.db, parsed["ap_threshold"], limit=3)
+        self.db.save_recommendations(event_id, [(c["name"], c["score"], c["signals"], rank)
+                                                for rank, c in enumerate(top3, 1)])
 
         dt_str = parsed["datetime"].strftime("%d.%m %H:%M")
         result = f"💧 **Дроп {dt_str}** | Порог {parsed['ap_threshold']}AP"
@@ -489,11 +2610,17 @@ class AlphaTrackerBot:
             gap_str = f"{gap[0]}-{gap[1]}" if gap else "—"
             result += f"  {i}. **{cand['name']}** (score {cand['score']}) | {cand['ap']}AP | вернут [{refund_str}] | последний [{gap_str}]\n"
 
-        result += f"\n⏰ Напоминания: -4ч, -3ч, -2ч, -1ч\n"
+        if pending:
+            offsets = ", ".join(f"-{r['offset_hours']}ч" for r in pending)
+            result += f"\n⏰ Напоминания: {offsets}\n"
+        else:
+            result += f"\n⏰ Напоминания: —\n"
+        capacity = RESERVE_DEFAULT_SLOTS if parsed["capacity"] is None else parsed["capacity"]
+        result += f"🎟 Мест: {capacity} — /reserve {event_id} <Имя>\n"
         result += f"(Дроп ID: {event_id})"
         return result
 
-    def cmd_sold(self, text: str) -> str:
+    def cmd_sold(self, text: str, trade_id: Optional[str] = None) -> str:
         parsed = parse_sold_command(text)
         if not parsed:
             return "❌ Неверный формат. Используй:\n/sold <Имя> <ASSET> QTYшт по PRICE$ комса FEE$"
@@ -507,14 +2634,14 @@ class AlphaTrackerBot:
         gross = qty * sell_price
         net = gross - fees
 
-        share_model = COMMISSIONED_MEMBERS.get(member_name, 0.0)
+        share_model = self.db.get_commissions().get(member_name, 0.0)
         if share_model > 0:
             member_payout = net * (1 - share_model)
             team_commission = net * share_model
             result = f"✅ **{member_name}** продал {qty} {asset} по ${sell_price}\n"
             result += f"Gross: ${gross:.2f} | Net: ${net:.2f}\n"
             result += f"🧑 Участнику: ${member_payout:.2f}\n"
-            result += f"👥 Команде (20%): ${team_commission:.2f}"
+            result += f"👥 Команде ({share_model:.0%}): ${team_commission:.2f}"
         else:
             result = f"✅ **{member_name}** продал {qty} {asset} по ${sell_price}\n"
             result += f"Gross: ${gross:.2f} | Net: ${net:.2f}\n"
@@ -522,18 +2649,154 @@ class AlphaTrackerBot:
 
         # Сохраняем в БД
         event_id = self.last_drop_event or 0
-        self.db.create_trade_report(event_id, member_name, asset, qty, sell_price, fees)
+        self.db.record_trade(event_id, member_name, asset, qty, sell_price, fees, trade_id=trade_id)
+
+        return result
+
+    def cmd_plan(self, text: str) -> str:
+        """Распределение участников по всем запланированным дропам окна"""
+        parsed = parse_plan_command(text, self.db.clock())
+        if not parsed:
+            return "❌ Используй: /plan [сегодня|завтра|Nч] [мест N] [расход N]"
+
+        drops = self.db.get_planned_drops(parsed["since_ts"], parsed["until_ts"])
+        if not drops:
+            return "📭 Нет запланированных дропов в этом окне"
+
+        # Ниже самого низкого порога окна участник никуда не попадёт — отсекаем в SQL
+        members = self.db.find_members(ap_min=min(d["ap_threshold"] for d in drops))
+        plan = plan_drop_assignments(members, drops,
+                                     slots=parsed["slots"], ap_spent=parsed["ap_spent"], rules=self.db.scoring)
+
+        # Рекомендации всех дропов — одной транзакцией
+        with self.db.transaction():
+            for d in drops:
+                self.db.save_recommendations(d["id"], [
+                    (c["name"], c["score"], c["signals"], rank)
+                    for rank, c in enumerate(plan[d["id"]], 1)
+                ])
+
+        result = f"🗓 **План на {len(drops)} дроп(ов)** | мест {parsed['slots']} | расход {parsed['ap_spent']}AP\n"
+        for d in drops:
+            dt_str = datetime.fromtimestamp(d["when_ts"], TZ).strftime("%d.%m %H:%M")
+            result += f"\n💧 **{dt_str}** | Порог {d['ap_threshold']}AP"
+            if d["symbol"]:
+                result += f" | {d['symbol']}"
+            result += f" (ID: {d['id']})\n"
+            if not plan[d["id"]]:
+                result += "  — нет участников с достаточным AP\n"
+            for i, cand in enumerate(plan[d["id"]], 1):
+                result += f"  {i}. **{cand['name']}** (score {cand['score']}) | {cand['ap']}AP | {cand['signals']}\n"
+        return result
+
+    def cmd_reserve(self, text: str) -> str:
+        """Бронь места на дроп (или список броней без имени)"""
+        parsed = parse_reserve_command(text)
+        if not parsed:
+            return "❌ Используй: /reserve <ID дропа> <Имя>"
+        event_id, member_name = parsed["event_id"], parsed["member_name"]
+        if member_name is None:
+            return self._format_reservations(event_id)
+
+        status, created = self.db.reserve_slot(event_id, member_name)
+        if status == "no_drop":
+            return f"❌ Нет запланированного дропа ID {event_id}"
+        if status == "no_member":
+            return f"❌ Участник {member_name} не найден"
+        if status == "confirmed":
+            result = f"🎟 **{member_name}** — место на дроп ID {event_id}"
+        else:
+            result = f"⏳ **{member_name}** — в листе ожидания дропа ID {event_id}"
+        if not created:
+            result += " (бронь уже была)"
+        return result
+
+    def cmd_release(self, text: str) -> str:
+        """Снятие брони; освободившееся место уходит первому в листе ожидания"""
+        parsed = parse_reserve_command(text)
+        if not parsed:
+            return "❌ Используй: /release <ID дропа> <Имя>"
+        event_id, member_name = parsed["event_id"], parsed["member_name"]
+
+        status, promoted = self.db.release_slot(event_id, member_name)
+        if status is None:
+            return f"❌ У {member_name} нет брони на дроп ID {event_id}"
+        result = f"↩️ **{member_name}** снял бронь с дропа ID {event_id}"
+        for name in promoted:
+            result += f"\n⬆️ **{name}** — из листа ожидания на место"
+        return result
+
+    def _format_reservations(self, event_id: int) -> str:
+        drop = self.db.get_drop_event(event_id)
+        if not drop:
+            return f"❌ Нет дропа ID {event_id}"
+        reservations = self.db.get_reservations(event_id)
+        confirmed = [r["member_name"] for r in reservations if r["status"] == "confirmed"]
+        waitlist = [r["member_name"] for r in reservations if r["status"] == "waitlist"]
+        result = f"🎟 **Дроп ID {event_id}** | мест {len(confirmed)}/{drop['capacity']}\n"
+        result += "".join(f"  {i}. {name}\n" for i, name in enumerate(confirmed, 1)) or "  —\n"
+        if waitlist:
+            result += f"⏳ Лист ожидания: {', '.join(waitlist)}"
+        return result.rstrip("\n")
+
+    def cmd_pnl(self, text: str) -> str:
+        """Выплаты участникам и комиссия команды по отчётам /sold"""
+        parsed = parse_pnl_command(text, self.db.clock())
+        if not parsed:
+            return "❌ Используй: /pnl [ID дропа | Имя | сегодня | неделя | месяц | Nд]"
 
+        rows = self.db.get_pnl(
+            event_id=parsed.get("event_id"),
+            member_name=parsed.get("member_name"),
+            since=parsed.get("since")
+        )
+        if not rows:
+            return f"📭 Нет продаж ({parsed['label']})"
+
+        result = f"💵 **P&L {parsed['label']}**\n"
+        total_net = total_payout = total_team = 0.0
+        for r in rows:
+            result += (f"• **{r['member_name']}**: {r['trades']} сд. | Net ${r['net_usd']:.2f} | "
+                       f"🧑 ${r['payout_usd']:.2f} | 👥 ${r['team_usd']:.2f}\n")
+            total_net += r["net_usd"]
+            total_payout += r["payout_usd"]
+            total_team += r["team_usd"]
+        result += f"\nИтого: Net ${total_net:.2f} | Участникам ${total_payout:.2f} | Команде ${total_team:.2f}"
         return result
 
+    def cmd_addmember(self, text: str) -> str:
+        """Добавляет участников в состав этого чата"""
+        names = [n.strip() for n in text[len("/addmember"):].split(",") if n.strip()]
+        if not names:
+            return "❌ Используй: /addmember Имя[, Имя2, ...]"
+
+        self.db.add_members(names)
+        return f"✅ В составе: {', '.join(names)}"
+
+    def cmd_commission(self, text: str) -> str:
+        """Доля команды от net для участника этого чата"""
+        match = re.search(r"/commission\s+(.+?)\s+([\d.]+)\s*(%?)$", text)
+        if not match:
+            return "❌ Используй: /commission <Имя> 0.2 (или 20%)"
+
+        name = match.group(1).strip()
+        share = float(match.group(2)) / (100 if match.group(3) else 1)
+        if not 0 <= share <= 1:
+            return "❌ Доля должна быть от 0 до 1 (0–100%)"
+
+        self.db.set_commission(name, share)
+        return f"✅ {name}: комиссия команды {share:.0%}"
+
     def cmd_who(self, text: str) -> str:
         """Быстрый топ-3 без создания дропа"""
-        pattern = r"/who\s+порог\s+(\d+)"
-        match = re.search(pattern, text)
-        if not match:
-            return "❌ Используй: /who порог N"
+        parsed = parse_who_command(text)
+        if not parsed:
+            return f"❌ Используй: /who порог N или /who порог A-B шаг S (до {WHO_MAX_THRESHOLDS} порогов)"
 
-        threshold = int(match.group(1))
+        if parsed["is_range"]:
+            return self._format_who_sweep(parsed["thresholds"], parsed["step"])
+
+        threshold = parsed["thresholds"][0]
         top3 = get_top_candidates(self.db, threshold, limit=3)
 
         result = f"🎯 **Топ-3 на порог {threshold}AP**\n"
@@ -544,30 +2807,538 @@ class AlphaTrackerBot:
 
         return result
 
+    def _format_who_sweep(self, thresholds: List[int], step: int) -> str:
+        sweep = get_top_candidates_sweep(self.db, thresholds, limit=3)
+
+        result = f"🎯 **Топ-3 на пороги {thresholds[0]}–{thresholds[-1]}AP (шаг {step})**\n"
+        for threshold in thresholds:
+            names = ", ".join(f"{c['name']} ({c['score']})" for c in sweep[threshold]) or "—"
+            result += f"`{threshold}` {names}\n"
+
+        return result
+
+
+# ============================================================================
+# ДИСПЕТЧЕР (параллельная обработка)
+# ============================================================================
+
+class CommandDispatcher:
+    """
+    Пул потоков с последовательной обработкой внутри ключа.
+
+    Сообщения одного чата (ключа) выполняются строго по очереди — порядок
+    /drop и /sold участника сохраняется, а разные чаты идут параллельно.
+    Общее число ожидающих сообщений ограничено: submit блокируется, пока
+    очередь полна, и тем самым притормаживает приём обновлений.
+    """
+
+    def __init__(self, handler: Callable[[object], None], workers: int = DISPATCH_WORKERS,
+                 max_pending: int = DISPATCH_QUEUE_SIZE):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self._handler = handler
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dispatch")
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._queues: Dict[object, deque] = {}
+        self._depth = 0
+
+    @property
+    def depth(self) -> int:
+        """Сколько сообщений ждут или обрабатываются"""
+        return self._depth
+
+    def submit(self, key: object, item: object, timeout: Optional[float] = None) -> bool:
+        """Ставит сообщение в очередь ключа; False — если очередь полна дольше timeout"""
+        if not self._slots.acquire(timeout=timeout):
+            return False
+
+        with self._lock:
+            self._depth += 1
+            queue = self._queues.get(key)
+            if queue is not None:
+                # Ключ уже обрабатывается — допишем в его очередь
+                queue.append(item)
+                return True
+            self._queues[key] = deque([item])
+
+        self._executor.submit(self._drain, key)
+        return True
+
+    def _drain(self, key: object):
+        while True:
+            with self._lock:
+                queue = self._queues[key]
+                if not queue:
+                    del self._queues[key]
+                    return
+                item = queue.popleft()
+
+            try:
+                self._handler(item)
+            except Exception as e:
+                print(f"❌ Ошибка обработки: {e}")
+            finally:
+                with self._lock:
+                    self._depth -= 1
+                self._slots.release()
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+
+
+# ============================================================================
+# ИСХОДЯЩИЕ СООБЩЕНИЯ
+# ============================================================================
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не больше capacity"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Сколько ждать до следующего токена (0 — можно сейчас)"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class OutboundMessage:
+    __slots__ = ("chat_id", "text", "reply_to", "thread_id", "attempts")
+
+    def __init__(self, chat_id: int, text: str, reply_to: Optional[int] = None,
+                 thread_id: Optional[int] = None):
+        self.chat_id = chat_id
+        self.text = text
+        self.reply_to = reply_to
+        self.thread_id = thread_id
+        self.attempts = 0
+
+
+class OutboundQueue:
+    """
+    Очередь исходящих сообщений с отдельным потоком отправки.
+
+    submit() не ждёт сеть. Поток отправляет по кругу между чатами, соблюдая
+    корзины токенов на чат и общую. Всё, что накопилось для одного чата
+    (и темы), склеивается в одно сообщение до TELEGRAM_MAX_MESSAGE символов.
+    На 429 чат ставится на паузу по retry_after, на прочие ошибки — по
+    экспоненциальной задержке, после OUTBOUND_MAX_ATTEMPTS сообщение
+    отбрасывается с записью в лог.
+    """
+
+    def __init__(self, send: Callable[[OutboundMessage], None],
+                 chat_rate: float = OUTBOUND_CHAT_RATE, chat_burst: float = OUTBOUND_CHAT_BURST,
+                 global_rate: float = OUTBOUND_GLOBAL_RATE):
+        self._send = send
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._global = TokenBucket(global_rate, global_rate)
+        self._cond = threading.Condition()
+        self._pending: "OrderedDict[tuple, deque]" = OrderedDict()
+        self._buckets: Dict[tuple, TokenBucket] = {}
+        self._paused_until: Dict[tuple, float] = {}
+        self._size = 0
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="outbound", daemon=True)
+        self._thread.start()
+        METRICS.gauge("alpha_outbound_pending", lambda: self._size, "Сообщений ждут отправки")
+
+    def __len__(self) -> int:
+        return self._size
+
+    def submit(self, chat_id: int, text: str, reply_to: Optional[int] = None,
+               thread_id: Optional[int] = None):
+        key = (chat_id, thread_id)
+        with self._cond:
+            self._pending.setdefault(key, deque()).append(OutboundMessage(chat_id, text, reply_to, thread_id))
+            self._size += 1
+            self._cond.notify()
+
+    def stop(self, timeout: float = 10.0):
+        """Дожидается отправки очереди (не дольше timeout) и останавливает поток"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._size and time.monotonic() < deadline:
+                self._cond.wait(0.1)
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join(timeout=1)
+
+    def _next_locked(self, now: float) -> Tuple[Optional[tuple], float]:
+        """Первый по кругу чат, готовый к отправке, иначе — сколько ждать"""
+        wait = self._global.wait_time(now)
+        if wait > 0:
+            return None, wait
+
+        wait = None
+        for key in self._pending:
+            delay = self._paused_until.get(key, 0) - now
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                delay = max(delay, bucket.wait_time(now))
+            if delay <= 0:
+                return key, 0
+            wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    def _coalesce_locked(self, key: tuple) -> OutboundMessage:
+        queue = self._pending[key]
+        first = queue.popleft()
+        parts = [first.text]
+        length = len(first.text)
+        merged = 1
+        while queue and length + 2 + len(queue[0].text) <= TELEGRAM_MAX_MESSAGE:
+            message = queue.popleft()
+            parts.append(message.text)
+            length += 2 + len(message.text)
+            merged += 1
+        if not queue:
+            del self._pending[key]
+        else:
+            self._pending.move_to_end(key)
+        self._size -= merged
+
+        if merged > 1:
+            METRICS.inc("alpha_outbound_coalesced_total", merged - 1)
+            first.text = "\n\n".join(parts)
+        return first
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopped:
+                        return
+                    now = time.monotonic()
+                    key, wait = self._next_locked(now) if self._pending else (None, None)
+                    if key is not None:
+                        break
+                    self._cond.wait(wait)
+
+                message = self._coalesce_locked(key)
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    bucket = self._buckets[key] = TokenBucket(self._chat_rate, self._chat_burst)
+                bucket.take(now)
+                self._global.take(now)
+
+            try:
+                with METRICS.timer("alpha_telegram_reply_seconds", kind="send"):
+                    self._send(message)
+                METRICS.inc("alpha_outbound_sent_total")
+                with self._cond:
+                    self._paused_until.pop(key, None)
+                    self._cond.notify_all()
+            except Exception as e:
+                self._retry(key, message, e)
+
+    def _retry(self, key: tuple, message: OutboundMessage, error: Exception):
+        message.attempts += 1
+        METRICS.inc("alpha_outbound_retries_total")
+        if message.attempts >= OUTBOUND_MAX_ATTEMPTS:
+            print(f"❌ Сообщение в чат {message.chat_id} не отправлено: {error}")
+            with self._cond:
+                self._cond.notify_all()
+            return
+
+        delay = min(OUTBOUND_BACKOFF_BASE_SEC * 2 ** (message.attempts - 1), OUTBOUND_BACKOFF_MAX_SEC)
+        if getattr(error, "error_code", None) == 429:
+            # Telegram сообщает, сколько ждать: parameters.retry_after
+            result = getattr(error, "result_json", None) or {}
+            delay = max(delay, float(result.get("parameters", {}).get("retry_after", 0)))
+
+        with self._cond:
+            # Возвращаем в начало очереди чата, чтобы сохранить порядок
+            self._pending.setdefault(key, deque()).appendleft(message)
+            self._pending.move_to_end(key, last=False)
+            self._size += 1
+            self._paused_until[key] = time.monotonic() + delay
+            self._cond.notify()
+
+
+# ============================================================================
+# МУЛЬТИЧАТ (тенанты)
+# ============================================================================
+
+class TenantRegistry:
+    """
+    Трекеры по чатам.
+
+    С base_dir каждый чат получает свою базу base_dir/chat_<id>.db — свой
+    состав, комиссии, дропы и блокировку записи. Без base_dir все чаты делят
+    один AlphaTrackerBot, как раньше. Открытыми держатся соединения не более
+    max_open баз (LRU): вытесняется давно не использованный и не занятый
+    сейчас чат, при следующем обращении соединения откроются заново.
+    """
+
+    def __init__(self, base_dir: Optional[str] = None, max_open: int = TENANT_CACHE_SIZE,
+                 on_open: Optional[Callable[[Optional[int], "AlphaTrackerBot"], None]] = None):
+        self.base_dir = base_dir
+        self.max_open = max_open
+        self.on_open = on_open
+        self._lock = threading.Lock()
+        self._trackers: Dict[int, AlphaTrackerBot] = {}
+        self._open: "OrderedDict[int, None]" = OrderedDict()
+        self._in_use: Dict[int, int] = {}
+        self._shared: Optional[AlphaTrackerBot] = None
+        if base_dir:
+            os.makedirs(base_dir, exist_ok=True)
+            # Состояние самого бота (offset getUpdates) — отдельно от баз чатов
+            self.state_db = Database(os.path.join(base_dir, "bot.db"), seed_defaults=False)
+        else:
+            self._shared = AlphaTrackerBot()
+            self.state_db = self._shared.db
+        METRICS.gauge("alpha_tenants_open", lambda: len(self._open), "Открытых баз чатов")
+
+    def shard_path(self, chat_id: int) -> str:
+        return os.path.join(self.base_dir, f"chat_{chat_id}.db")
+
+    def known_chats(self) -> List[int]:
+        """Чаты, у которых уже есть база"""
+        chats = []
+        for filename in os.listdir(self.base_dir):
+            match = re.fullmatch(r"chat_(-?\d+)\.db", filename)
+            if match:
+                chats.append(int(match.group(1)))
+        return chats
+
+    def open_existing(self):
+        """Поднимает трекеры всех известных чатов (например, чтобы ожили напоминания)"""
+        if self._shared is not None:
+            if self.on_open:
+                self.on_open(None, self._shared)
+            return
+        for chat_id in self.known_chats():
+            with self.acquire(chat_id):
+                pass
+
+    @contextmanager
+    def acquire(self, chat_id: int):
+        """with registry.acquire(chat_id) as tracker: ... — пока занят, базу не вытеснят"""
+        if self._shared is not None:
+            yield self._shared
+            return
+
+        with self._lock:
+            tracker = self._trackers.get(chat_id)
+            created = tracker is None
+            if created:
+                tracker = AlphaTrackerBot(Database(self.shard_path(chat_id), seed_defaults=False))
+                # Фоновые задачи чата тоже входят через acquire — вытеснение закрывает
+                # только соединения, которыми сейчас никто не пользуется
+                tracker.pin = lambda: self.acquire(chat_id)
+                self._trackers[chat_id] = tracker
+            self._in_use[chat_id] = self._in_use.get(chat_id, 0) + 1
+            self._open[chat_id] = None
+            self._open.move_to_end(chat_id)
+            self._evict_locked()
+
+        if created and self.on_open:
+            self.on_open(chat_id, tracker)
+        try:
+            yield tracker
+        finally:
+            with self._lock:
+                self._in_use[chat_id] -= 1
+                self._evict_locked()
+
+    def _evict_locked(self):
+        excess = len(self._open) - self.max_open
+        if excess <= 0:
+            return
+        for chat_id in list(self._open):
+            if excess <= 0:
+                break
+            if self._in_use.get(chat_id):
+                continue
+            del self._open[chat_id]
+            self._trackers[chat_id].db.close()
+            excess -= 1
+
+    def database_paths(self) -> List[str]:
+        """Все базы на диске: общая или базы чатов вместе с bot.db"""
+        if self._shared is not None:
+            return [self._shared.db.db_path]
+        return [self.shard_path(chat_id) for chat_id in self.known_chats()] + [self.state_db.db_path]
+
+    def trackers(self) -> List["AlphaTrackerBot"]:
+        if self._shared is not None:
+            return [self._shared]
+        with self._lock:
+            return list(self._trackers.values())
+
+    def close(self):
+        for tracker in self.trackers():
+            if tracker.reminders:
+                tracker.reminders.stop()
+            if tracker.aging:
+                tracker.aging.stop()
+            if tracker.offhours:
+                tracker.offhours.stop()
+            tracker.db.close()
+        if self._shared is None:
+            self.state_db.close()
+
 
 # ============================================================================
 # TELEGRAM BOT
 # ============================================================================
 
-import os
+import argparse
 from typing import Optional
 
 # 👇 СЮДА ВСТАВЬ ТОКЕН! Или задай переменную окружения BOT_TOKEN
 BOT_TOKEN = os.getenv("BOT_TOKEN", "YOUR_BOT_TOKEN_HERE")
 
+# Куда слать напоминания о дропах (опционально — тема форума)
+REMINDER_CHAT_ID = os.getenv("CHAT_ID")
+REMINDER_THREAD_ID = os.getenv("THREAD_ID")
+
+# getUpdates: размер страницы (максимум Bot API), ожидание long polling и пауза после ошибки (сек)
+POLL_PAGE_SIZE = 100
+POLL_TIMEOUT_SEC = 25
+POLL_RETRY_SEC = 3
+
+# Webhook вместо polling: задай WEBHOOK_URL (публичный https-адрес, путь из него же).
+# Секрет сверяется с заголовком X-Telegram-Bot-Api-Secret-Token; без WEBHOOK_SECRET — случайный.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT") or os.getenv("PORT") or 8443)
+WEBHOOK_MAX_BODY = 1 << 20
+# Сколько держать простаивающее keep-alive соединение (сек)
+WEBHOOK_IDLE_SEC = 75
+
+# Другой адрес Bot API (например, локальная заглушка): http://127.0.0.1:8081
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+
+# Кому доступны служебные команды (/metrics); пусто — всем
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()}
+ADMIN_COMMANDS = ("/metrics", "/commission")
+
 # Если хочешь использовать Telegram, раскомментируй:
 # pip install pyTelegramBotAPI
 # import telebot
 # bot_tg = telebot.TeleBot(BOT_TOKEN)
 
+class WebhookServer:
+    """
+    Приём обновлений Telegram по webhook.
+
+    Принимает POST на path, сверяет X-Telegram-Bot-Api-Secret-Token с secret
+    (hmac.compare_digest) и отдаёт разобранный JSON в on_update. Ответ 200
+    уходит сразу: on_update только ставит сообщение в очередь диспетчера.
+    HTTP/1.1 keep-alive — Telegram шлёт обновления по открытым соединениям.
+    """
+
+    def __init__(self, on_update: Callable[[Dict], None], secret: str, host: str = WEBHOOK_HOST,
+                 port: int = WEBHOOK_PORT, path: str = "/"):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        self.on_update = on_update
+        self.secret = secret
+        self.path = path
+        webhook = self
+
+        class WebhookHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            timeout = WEBHOOK_IDLE_SEC
+
+            def do_POST(self):
+                webhook._handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), WebhookHandler)
+        self.httpd.daemon_threads = True
+
+    @property
+    def port(self) -> int:
+        return self.httpd.server_address[1]
+
+    @staticmethod
+    def _reply(request, status: int):
+        request.send_response(status)
+        request.send_header("Content-Length", "0")
+        request.end_headers()
+
+    def _handle(self, request):
+        import hmac
+
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        length = request.headers.get("Content-Length") or "0"
+        body = None
+        # Путь и секрет — до чтения тела: чужой запрос не держит поток обработчика
+        if request.path.split("?")[0] != self.path:
+            status = 404
+        elif not hmac.compare_digest(token.encode(), self.secret.encode()):
+            status = 403
+        elif not length.isdecimal():
+            # "-1" заставил бы rfile.read ждать до закрытия соединения
+            status = 400
+        elif int(length) > WEBHOOK_MAX_BODY:
+            status = 413
+        else:
+            body = request.rfile.read(int(length))
+            try:
+                update = json.loads(body)
+            except ValueError:
+                update = None
+            if isinstance(update, dict) and "update_id" in update:
+                self.on_update(update)
+                status = 200
+            else:
+                status = 400
+        if body is None:
+            # Тело не прочитано — соединение дальше не годится
+            request.close_connection = True
+        METRICS.inc("alpha_webhook_requests_total", status=status)
+        self._reply(request, status)
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+
 class TelegramBotAdapter:
     """Адаптер для pyTelegramBotAPI"""
     
     def __init__(self, token: str):
         try:
             import telebot
-            self.bot = telebot.TeleBot(token)
-            self.tracker = AlphaTrackerBot()
+            if TELEGRAM_API_URL:
+                telebot.apihelper.API_URL = TELEGRAM_API_URL.rstrip("/") + "/bot{0}/{1}"
+            # Иначе long_polling_timeout=0 (drain_backlog) подменяется умолчанием в 20 с
+            telebot.apihelper.LONG_POLLING_TIMEOUT = 0
+            # Обработчик только ставит сообщение в очередь диспетчера,
+            # поэтому встроенный пул telebot не нужен
+            self.bot = telebot.TeleBot(token, threaded=False)
+            self.tenants = TenantRegistry(TENANTS_DIR, on_open=self.start_tenant)
+            self.outbound = OutboundQueue(self.send_outbound)
+            self.dispatcher = CommandDispatcher(self.process_message)
+            self.command_log = CommandLog(COMMAND_LOG) if COMMAND_LOG else None
+            # update_id, отданные диспетчеру и ещё не обработанные: сохранённый
+            # offset не обгоняет самый ранний из них
+            self._inflight: Set[int] = set()
+            self._inflight_cond = threading.Condition()
+            self._polled_id: Optional[int] = None
+            self.backups: Optional[DailyJob] = None
+            METRICS.gauge("alpha_dispatch_queue_depth", lambda: self.dispatcher.depth,
+                          "Сообщений в очереди диспетчера")
             self.is_connected = True
             print(f"✅ Telegram бот подключен!")
         except ImportError:
@@ -578,16 +3349,209 @@ class TelegramBotAdapter:
             print(f"❌ Ошибка подключения: {e}")
             self.is_connected = False
 
-    def setup_handlers(self):
-        """Регистрирует обработчики сообщений"""
-        if not self.is_connected:
+    @staticmethod
+    def _messages(updates: list) -> list:
+        """[(update_id, message)] для обновлений с текстом"""
+        return [(u.update_id, u.message) for u in updates if u.message is not None and u.message.text]
+
+    @staticmethod
+    def _denied(message) -> bool:
+        return (message.text.strip().startswith(ADMIN_COMMANDS) and bool(ADMIN_IDS)
+                and message.from_user.id not in ADMIN_IDS)
+
+    def handle_updates(self, updates: list):
+        """Обновления из getUpdates или webhook — в очередь диспетчера по чатам"""
+        for update_id, message in self._messages(updates):
+            with self._inflight_cond:
+                self._inflight.add(update_id)
+            self.dispatcher.submit(message.chat.id, (update_id, message))
+
+    def process_message(self, item: tuple):
+        """Выполняется в пуле диспетчера: команда + ответ"""
+        update_id, message = item
+        try:
+            text = message.text.strip()
+            if self.command_log:
+                self.command_log.append(message.date, message.chat.id, text)
+            if self._denied(message):
+                response = "⛔ Команда доступна только администраторам."
+            else:
+                with self.tenants.acquire(message.chat.id) as tracker:
+                    response = tracker.handle_update(update_id, text)
+                if response is None:
+                    # Уже применено до рестарта — не отвечаем повторно
+                    return
+            # Ответ уходит через очередь: обработчик не ждёт сеть
+            self.outbound.submit(message.chat.id, response, reply_to=message.message_id,
+                                 thread_id=getattr(message, "message_thread_id", None))
+        finally:
+            with self._inflight_cond:
+                self._inflight.discard(update_id)
+                self._inflight_cond.notify_all()
+
+    def send_outbound(self, message: OutboundMessage):
+        """Выполняется в потоке OutboundQueue"""
+        self.bot.send_message(
+            message.chat_id, message.text,
+            reply_to_message_id=message.reply_to,
+            message_thread_id=message.thread_id,
+            parse_mode="Markdown"
+        )
+
+    def start_tenant(self, chat_id: Optional[int], tracker: AlphaTrackerBot):
+        """Запускает напоминания и старение трекера; у базы чата напоминания уходят в этот чат"""
+        tracker.start_reminders(lambda reminders: self.send_reminders(reminders, chat_id))
+        tracker.start_aging()
+        tracker.start_offhours(lambda text: self.send_notice(text, chat_id))
+
+    def send_reminders(self, reminders: List[Dict], chat_id: Optional[int] = None):
+        """Отправляет пачку напоминаний одним сообщением"""
+        self.send_notice(format_reminders(reminders), chat_id)
+
+    def send_notice(self, text: str, chat_id: Optional[int] = None):
+        """Сообщение бота по своей инициативе: в чат тенанта или в CHAT_ID/THREAD_ID"""
+        thread_id = None
+        if chat_id is None:
+            chat_id = REMINDER_CHAT_ID
+            thread_id = int(REMINDER_THREAD_ID) if REMINDER_THREAD_ID else None
+        if not chat_id:
+            print(f"⚠️  CHAT_ID не задан, сообщение:\n{text}")
             return
+        self.outbound.submit(chat_id, text, thread_id=thread_id)
 
-        @self.bot.message_handler(func=lambda message: True)
-        def handle_message(message):
+    def run(self):
+        """Webhook, если задан WEBHOOK_URL, иначе long polling"""
+        if WEBHOOK_URL:
+            self.start_webhook(WEBHOOK_URL, WEBHOOK_SECRET)
+        else:
+            self.start_polling()
+
+    def _get_updates(self, offset: int, wait_sec: int) -> list:
+        return self.bot.get_updates(offset=offset, limit=POLL_PAGE_SIZE, timeout=wait_sec + 10,
+                                    long_polling_timeout=wait_sec, allowed_updates=["message"])
+
+    def _save_offset(self, update_id: int):
+        self.tenants.state_db.set_state("last_update_id", str(update_id))
+
+    def drain_backlog(self) -> int:
+        """
+        Забирает обновления, накопившиеся за время простоя, страницами по
+        POLL_PAGE_SIZE начиная с сохранённого offset. Команды каждого чата со
+        страницы применяются одной пачкой (AlphaTrackerBot.handle_batch),
+        в чат уходит одна сводка. Возвращает число обновлений.
+        """
+        offset = int(self.tenants.state_db.get_state("last_update_id") or 0) + 1
+        total = 0
+        while True:
+            try:
+                updates = self._get_updates(offset, 0)
+            except Exception as e:
+                print(f"❌ Ошибка getUpdates: {e}")
+                time.sleep(POLL_RETRY_SEC)
+                continue
+            if not updates:
+                return total
+
+            by_chat: Dict[int, list] = {}
+            for update_id, message in self._messages(updates):
+                by_chat.setdefault(message.chat.id, []).append((update_id, message))
+            for chat_id, messages in by_chat.items():
+                self._apply_backlog(chat_id, messages)
+
+            offset = updates[-1].update_id + 1
+            self._save_offset(offset - 1)
+            total += len(updates)
+
+    def _apply_backlog(self, chat_id: int, messages: list):
+        items = []
+        denied = 0
+        for update_id, message in messages:
             text = message.text.strip()
-            response = self.tracker.handle_command(text)
-            self.bot.reply_to(message, response, parse_mode="Markdown")
+            if self.command_log:
+                self.command_log.append(message.date, chat_id, text)
+            if self._denied(message):
+                denied += 1
+                continue
+            items.append({"update_id": update_id, "ts": message.date, "text": text})
+
+        summary = None
+        if items:
+            with self.tenants.acquire(chat_id) as tracker:
+                summary = tracker.handle_batch(items)
+        if denied:
+            summary = (summary + "\n" if summary else "") + f"⛔ Служебных команд пропущено: {denied}"
+        if summary:
+            last = messages[-1][1]
+            self.outbound.submit(chat_id, summary, reply_to=last.message_id,
+                                 thread_id=getattr(last, "message_thread_id", None))
+
+    def _handled_id_locked(self) -> int:
+        """Последний update_id, до которого включительно всё обработано"""
+        return min(self._inflight) - 1 if self._inflight else self._polled_id
+
+    def poll_forever(self):
+        """
+        Long polling с offset из базы: после рестарта продолжает с того же места.
+        Offset (и подтверждение в Telegram) не обгоняет обновления, которые ещё
+        ждут в диспетчере, — после падения они придут заново, а повторы уже
+        применённых отсеет handle_update.
+        """
+        self._polled_id = saved = int(self.tenants.state_db.get_state("last_update_id") or 0)
+        while True:
+            with self._inflight_cond:
+                handled = self._handled_id_locked()
+            if handled != saved:
+                self._save_offset(handled)
+                saved = handled
+
+            try:
+                updates = self._get_updates(handled + 1, POLL_TIMEOUT_SEC)
+            except Exception as e:
+                print(f"❌ Ошибка getUpdates: {e}")
+                time.sleep(POLL_RETRY_SEC)
+                continue
+
+            fresh = [u for u in updates if u.update_id > self._polled_id]
+            if not fresh:
+                if updates:
+                    # Вся страница ещё в обработке — ждём, пока диспетчер что-то закончит
+                    with self._inflight_cond:
+                        self._inflight_cond.wait_for(lambda: self._handled_id_locked() != handled,
+                                                     timeout=POLL_TIMEOUT_SEC)
+                continue
+            self.handle_updates(fresh)
+            with self._inflight_cond:
+                self._polled_id = fresh[-1].update_id
+
+    def _ready(self, mode: str):
+        self.tenants.open_existing()
+        if BACKUP_DIR:
+            self.backups = DailyJob(lambda: backup_all(self.tenants.database_paths()), hour=BACKUP_HOUR,
+                                    name="backup")
+            self.backups.start()
+
+        started = time.perf_counter()
+        drained = self.drain_backlog()
+        if drained:
+            print(f"📬 Накопившихся обновлений: {drained} за {(time.perf_counter() - started) * 1000:.0f} мс")
+
+        startup_sec = time.perf_counter() - STARTUP_T0
+        METRICS.gauge("alpha_startup_seconds", lambda: startup_sec, "Время от запуска до приёма сообщений")
+        print(f"⏱  Запуск до {mode}: {startup_sec * 1000:.0f} мс")
+
+    def _shutdown(self):
+        if self.backups:
+            self.backups.stop()
+        self.dispatcher.shutdown()
+        if self._polled_id is not None:
+            # Очередь диспетчера обработана — offset догоняет последнее полученное
+            with self._inflight_cond:
+                handled = self._handled_id_locked()
+            self._save_offset(handled)
+        self.outbound.stop()
+        self.tenants.close()
+        if self.command_log:
+            self.command_log.close()
 
     def start_polling(self):
         """Запускает polling"""
@@ -595,19 +3559,122 @@ class TelegramBotAdapter:
             print("❌ Telegram адаптер не инициализирован.")
             return
 
-        print("🚀 Telegram бот начал слушать сообщения...")
         try:
-            self.bot.infinity_polling()
+            # Webhook и getUpdates несовместимы — снимаем оставшийся от прошлого запуска
+            self.bot.remove_webhook()
+            self._ready("polling")
+
+            print("🚀 Telegram бот начал слушать сообщения...")
+            self.poll_forever()
         except KeyboardInterrupt:
             print("\n👋 Бот остановлен")
+        finally:
+            self._shutdown()
+
+    def process_update(self, update: Dict):
+        """Обновление из webhook — в диспетчер, как и при polling"""
+        import telebot
+        self.handle_updates([telebot.types.Update.de_json(update)])
+
+    def start_webhook(self, url: str, secret: Optional[str] = None):
+        """Регистрирует webhook в Telegram и принимает обновления локальным HTTP-сервером"""
+        if not self.is_connected:
+            print("❌ Telegram адаптер не инициализирован.")
+            return
+
+        import secrets
+        from urllib.parse import urlsplit
+
+        secret = secret or secrets.token_urlsafe(32)
+        server = WebhookServer(self.process_update, secret, path=urlsplit(url).path or "/")
+        try:
+            # Накопившееся забираем через getUpdates, пока webhook не включён
+            self.bot.remove_webhook()
+            self._ready("webhook")
+            self.bot.set_webhook(url=url, secret_token=secret, allowed_updates=["message"])
+
+            print(f"🚀 Webhook {url} → {WEBHOOK_HOST}:{server.port}{server.path}")
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print("\n👋 Бот остановлен")
+        finally:
+            server.httpd.server_close()
+            self._shutdown()
 
 
 # ============================================================================
 # ГЛАВНОЕ МЕНЮ (CLI + Telegram)
 # ============================================================================
 
+def build_arg_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="AlphaTrackerBot — управление дропами")
+    sub = parser.add_subparsers(dest="command")
+
+    p_import = sub.add_parser("import", help="импорт состава из CSV одной транзакцией")
+    p_import.add_argument("path", help="CSV с колонками name,ap,refund_days,last_gap")
+    p_import.add_argument("--db", default=DB_PATH, help="путь к базе")
+
+    p_export = sub.add_parser("export", help="дописать колоночный снимок сделок и дропов")
+    p_export.add_argument("directory", help="каталог снимка")
+    p_export.add_argument("--db", default=DB_PATH, help="путь к базе")
+
+    p_backup = sub.add_parser("backup", help="онлайн-копия базы (бот может работать)")
+    p_backup.add_argument("--db", default=DB_PATH, help="путь к базе")
+    p_backup.add_argument("--dir", default=BACKUP_DIR or "backups", help="каталог копий")
+    p_backup.add_argument("--keep", type=int, default=BACKUP_KEEP, help="сколько копий хранить")
+
+    p_restore = sub.add_parser("restore", help="восстановить базу из копии (бот остановлен)")
+    p_restore.add_argument("backup", help="файл копии")
+    p_restore.add_argument("--db", default=DB_PATH, help="путь к базе")
+
+    return parser
+
+
+def run_cli_command(argv: List[str]) -> bool:
+    """Выполняет служебную команду из argv; False — если команды нет"""
+    args = build_arg_parser().parse_args(argv)
+    if args.command is None:
+        return False
+
+    if args.command == "import":
+        db = Database(args.db)
+        try:
+            print(import_roster_csv(db, args.path))
+        except OSError as e:
+            print(f"❌ Не удалось прочитать файл: {e}")
+        finally:
+            db.close()
+    elif args.command == "export":
+        db = Database(args.db)
+        try:
+            with ColumnarSnapshot(args.directory) as snapshot:
+                added = snapshot.export(db)
+                print(f"✅ Снимок {args.directory}: +{added['trades']} сделок, +{added['drops']} дропов "
+                      f"(всего {snapshot.meta['rows']['trades']} / {snapshot.meta['rows']['drops']})")
+                for asset, price in sorted(snapshot.avg_sell_price_by_asset().items()):
+                    print(f"   {asset}: средняя цена ${price:.4f}")
+        finally:
+            db.close()
+    elif args.command == "backup":
+        path = backup_database(args.db, args.dir, keep=args.keep)
+        print(f"✅ Копия {args.db} → {path} ({os.path.getsize(path) / 1e6:.1f} МБ)")
+    elif args.command == "restore":
+        try:
+            previous = restore_database(args.backup, args.db)
+        except (OSError, sqlite3.DatabaseError, ValueError) as e:
+            print(f"❌ Не удалось восстановить: {e}")
+        else:
+            print(f"✅ {args.db} восстановлена из {args.backup}")
+            if previous:
+                print(f"   Прежняя база сохранена в {previous}")
+    return True
+
+
 def main():
     print("🤖 AlphaTrackerBot v1.0\n")
+
+    if run_cli_command(sys.argv[1:]):
+        return
     
     # Проверяем токен и окружение
     is_render = os.getenv("RENDER") == "true"
@@ -623,13 +3690,14 @@ def main():
         print("   python3 alpha_tracker_bot.py\n")
         return
 
+    start_metrics_exporter()
+
     # На Render/серверах запускаем только Telegram режим (без input)
     if is_render:
         print("🚀 Запуск на Render (Telegram режим)\n")
         tg_bot = TelegramBotAdapter(BOT_TOKEN)
         if tg_bot.is_connected:
-            tg_bot.setup_handlers()
-            tg_bot.start_polling()
+            tg_bot.run()
     else:
         # Локально: спрашиваем режим
         try:
@@ -643,12 +3711,16 @@ def main():
             # Telegram режим
             tg_bot = TelegramBotAdapter(BOT_TOKEN)
             if tg_bot.is_connected:
-                tg_bot.setup_handlers()
-                tg_bot.start_polling()
+                tg_bot.run()
         else:
             # CLI режим
             bot = AlphaTrackerBot()
-            print("🤖 AlphaTrackerBot запущен (CLI режим)")
+            bot.start_reminders(lambda reminders: print(f"\n{format_reminders(reminders)}\n"))
+            bot.start_aging()
+            bot.start_offhours(lambda text: print(f"\n{text}\n"))
+            if BACKUP_DIR:
+                DailyJob(lambda: backup_all([bot.db.db_path]), hour=BACKUP_HOUR, name="backup").start()
+            print(f"🤖 AlphaTrackerBot запущен (CLI режим) за {(time.perf_counter() - STARTUP_T0) * 1000:.0f} мс")
             print("Введи команду или /start для справки. /exit для выхода.\n")
 
             while True:
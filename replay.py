@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+Офлайн-реплей команд и what-if по правилам score.
+
+    python replay.py commands.log --variant "мягче:refund_max=5,rest_min=5" \
+                                  --variant "комса25:commission.Серёга=0.25"
+
+Прогоняет лог команд (COMMAND_LOG бота: JSON-строки {"ts", "chat_id", "text"})
+через AlphaTrackerBot.handle_command на базе в памяти. Часы подменяются
+временем из лога, поэтому рабочие часы, «завтра» в /newdrop и ежедневное
+старение счётчиков ведут себя как в момент записи. Базовый прогон и каждый
+вариант идут в своём процессе параллельно; в отчёте — в каких дропах
+поменялись рекомендации и как изменились выплаты участникам и команде.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from main import (
+    TZ, AlphaTrackerBot, Database, ScoringRules, import_roster_csv, read_command_log,
+)
+
+BASELINE = "baseline"
+
+
+class ReplayClock:
+    """Часы реплея: «сейчас» — время текущей команды из лога"""
+
+    def __init__(self, ts: float = 0.0):
+        self.ts = ts
+
+    def __call__(self) -> datetime:
+        return datetime.fromtimestamp(self.ts, TZ)
+
+
+# ============================================================================
+# ВАРИАНТЫ
+# ============================================================================
+
+def parse_variant(spec: str) -> Dict:
+    """
+    «имя:refund_max=5,surplus_min=15,commission.Имя=0.25» → вариант.
+    Ключи без префикса — поля ScoringRules, commission.<Имя> — доля команды.
+    """
+    name, _, params = spec.partition(":")
+    if not name or not params:
+        raise ValueError(f"вариант без имени или параметров: {spec!r}")
+
+    rules: Dict[str, int] = {}
+    commissions: Dict[str, float] = {}
+    for item in params.split(","):
+        key, _, value = item.partition("=")
+        key = key.strip()
+        if key.startswith("commission."):
+            commissions[key[len("commission."):]] = float(value)
+        elif key in ScoringRules.__slots__:
+            rules[key] = int(value)
+        else:
+            raise ValueError(f"неизвестный параметр {key!r} в варианте {name!r}")
+    return {"name": name.strip(), "rules": rules, "commissions": commissions}
+
+
+# ============================================================================
+# ПРОГОН
+# ============================================================================
+
+def run_variant(variant: Dict, commands: List[Tuple[float, str]], roster: Optional[str]) -> Dict:
+    """Выполняется в процессе пула: весь лог через одного бота на базе в памяти"""
+    start = time.perf_counter()
+    clock = ReplayClock(commands[0][0] if commands else time.time())
+    rules = ScoringRules(**variant["rules"])
+    # База в памяти у каждого потока своя — весь прогон идёт в одном потоке
+    db = Database(":memory:", clock=clock, scoring=rules)
+    if roster:
+        import_roster_csv(db, roster)
+    for member_name, share in variant["commissions"].items():
+        db.set_commission(member_name, share)
+    bot = AlphaTrackerBot(db)
+
+    errors = 0
+    day = None
+    for ts, text in commands:
+        clock.ts = ts
+        # Старение счётчиков — при смене дня, как у DailyJob
+        today = clock().date()
+        if today != day:
+            db.age_members()
+            day = today
+        try:
+            bot.handle_command(text)
+        except Exception:
+            errors += 1
+
+    conn = db.get_conn()
+    recommendations = {}
+    for row in conn.execute("""SELECT d.id, d.when_ts, d.ap_threshold, d.symbol, r.member_name
+                               FROM drop_events d LEFT JOIN recommendations r ON r.event_id = d.id
+                               ORDER BY d.id, r.rank"""):
+        drop = recommendations.setdefault(row[0], {"when_ts": row[1], "ap_threshold": row[2],
+                                                   "symbol": row[3], "members": []})
+        if row[4] is not None:
+            drop["members"].append(row[4])
+
+    payouts = {r["member_name"]: {"payout_usd": r["payout_usd"], "team_usd": r["team_usd"]}
+               for r in db.get_pnl()}
+    db.close()
+    return {
+        "name": variant["name"],
+        "rules": repr(rules),
+        "commands": len(commands),
+        "errors": errors,
+        "seconds": time.perf_counter() - start,
+        "recommendations": recommendations,
+        "payouts": payouts,
+    }
+
+
+def run_all(variants: List[Dict], commands: List[Tuple[float, str]], roster: Optional[str],
+            workers: Optional[int] = None) -> List[Dict]:
+    """Базовый прогон и варианты — параллельно, по процессу на вариант"""
+    with ProcessPoolExecutor(max_workers=workers or min(len(variants), os.cpu_count() or 1)) as pool:
+        futures = [pool.submit(run_variant, v, commands, roster) for v in variants]
+        return [f.result() for f in futures]
+
+
+# ============================================================================
+# ОТЧЁТ
+# ============================================================================
+
+def compare(base: Dict, other: Dict) -> Dict:
+    """Дропы с другими рекомендациями и разница выплат относительно базового прогона"""
+    drops = []
+    for event_id, drop in base["recommendations"].items():
+        members = other["recommendations"].get(event_id, {}).get("members", [])
+        if members != drop["members"]:
+            drops.append({"event_id": event_id, **drop, "variant": members})
+
+    payouts = {}
+    for member_name in sorted(set(base["payouts"]) | set(other["payouts"])):
+        before = base["payouts"].get(member_name, {"payout_usd": 0.0, "team_usd": 0.0})
+        after = other["payouts"].get(member_name, {"payout_usd": 0.0, "team_usd": 0.0})
+        if abs(after["payout_usd"] - before["payout_usd"]) > 0.005:
+            payouts[member_name] = {"before": before["payout_usd"], "after": after["payout_usd"]}
+
+    def total(result: Dict, key: str) -> float:
+        return sum(p[key] for p in result["payouts"].values())
+
+    return {
+        "changed_drops": drops,
+        "changed_payouts": payouts,
+        "team_usd": {"before": total(base, "team_usd"), "after": total(other, "team_usd")},
+        "members_usd": {"before": total(base, "payout_usd"), "after": total(other, "payout_usd")},
+    }
+
+
+def format_report(results: List[Dict], diffs: Dict[str, Dict], wall_sec: float, show: int) -> str:
+    base = results[0]
+    lines = [f"🔁 Реплей: {base['commands']} команд, {len(base['recommendations'])} дропов, "
+             f"{len(results)} прогон(ов) за {wall_sec:.2f} с"]
+    for r in results:
+        lines.append(f"   {r['name']}: {r['rules']} — {r['seconds']:.2f} с, ошибок {r['errors']}")
+
+    for name, diff in diffs.items():
+        lines.append(f"\n▶ {name}: рекомендации изменились в {len(diff['changed_drops'])} "
+                     f"из {len(base['recommendations'])} дропов")
+        for d in diff["changed_drops"][:show]:
+            dt_str = datetime.fromtimestamp(d["when_ts"], TZ).strftime("%d.%m %H:%M")
+            lines.append(f"   • дроп {d['event_id']} ({dt_str}, порог {d['ap_threshold']}): "
+                         f"{', '.join(d['members']) or '—'} → {', '.join(d['variant']) or '—'}")
+        if len(diff["changed_drops"]) > show:
+            lines.append(f"   … ещё {len(diff['changed_drops']) - show}")
+
+        team, members = diff["team_usd"], diff["members_usd"]
+        lines.append(f"   выплаты: участникам ${members['before']:.2f} → ${members['after']:.2f}, "
+                     f"команде ${team['before']:.2f} → ${team['after']:.2f}")
+        for member_name, p in list(diff["changed_payouts"].items())[:show]:
+            lines.append(f"   • {member_name}: ${p['before']:.2f} → ${p['after']:.2f}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-реплей команд AlphaTrackerBot")
+    parser.add_argument("log", help="лог команд (JSON-строки ts/chat_id/text)")
+    parser.add_argument("--variant", action="append", default=[],
+                        help="имя:ключ=значение,... (refund_max, surplus_min, rest_min, commission.<Имя>)")
+    parser.add_argument("--chat", type=int, help="только команды этого чата")
+    parser.add_argument("--roster", help="CSV с начальным составом (как у main.py import)")
+    parser.add_argument("--workers", type=int, help="процессов в пуле (по умолчанию — по числу вариантов)")
+    parser.add_argument("--show", type=int, default=10, help="сколько различий выводить на вариант")
+    parser.add_argument("--output", help="файл для полного JSON-результата")
+    args = parser.parse_args()
+
+    try:
+        variants = [{"name": BASELINE, "rules": {}, "commissions": {}}]
+        variants += [parse_variant(spec) for spec in args.variant]
+    except ValueError as e:
+        parser.error(str(e))
+
+    commands = read_command_log(args.log, args.chat)
+    print(f"⏱  {len(commands)} команд, {len(variants)} прогон(ов)...", file=sys.stderr)
+
+    start = time.perf_counter()
+    results = run_all(variants, commands, args.roster, args.workers)
+    wall_sec = time.perf_counter() - start
+
+    diffs = {r["name"]: compare(results[0], r) for r in results[1:]}
+    print(format_report(results, diffs, wall_sec, args.show))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"results": results, "diffs": diffs}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()